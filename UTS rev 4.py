@@ -1,20 +1,53 @@
-import tkinter as tk
-from tkinter import messagebox, Canvas, Frame, Label, Button
-import copy
+try:
+    import tkinter as tk
+    from tkinter import messagebox, Canvas, Frame, Label, Button
+except ImportError:  # Headless servers only need the engine and the command line tools
+    tk = None
 import random
+import time
+import threading
+import queue
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+import mmap
+import struct
+import tracemalloc
+import traceback
+from array import array
+from collections import deque
+try:
+    import numpy as np
+except ImportError:  # Root moves are then scored one by one in Python
+    np = None
+
+# Sides and piece kinds used by the bitboard position
+PLAYER = 0
+AI = 1
+
+PION, LANCER, KNIGHT, SILVER, BISHOP, ROOK, GOLD, KING = range(8)
+PROMOTED = 8  # Added to a kind to get its promoted kind
+PIECE_KINDS = 16
+HAND_KINDS = 7  # Pion..Gold can be held in hand
+ALL_SQUARES = (1 << 81) - 1
 
 class ShogiPiece:
-    def __init__(self, name, kanji, romaji, is_player=True):
-        self.name = name
-        self.kanji = kanji
-        self.romaji = romaji
+    # Only the side and the promotion and capture flags vary between pieces of a
+    # type; names and display strings are class attributes shared by all of them
+    __slots__ = ("is_player", "promoted", "captured")
+    kind = None
+    name = None
+    kanji = None
+    romaji = None
+    promoted_romaji = None
+    can_be_promoted = True  # By default pieces can be promoted
+
+    def __init__(self, is_player=True):
         self.is_player = is_player
         self.promoted = False
         self.captured = False
-        self.can_be_promoted = True  # By default pieces can be promoted
-
-    def get_moves(self, board, x, y):
-        return []
 
     def can_promote(self, from_y, to_y):
         if not self.can_be_promoted or self.promoted:
@@ -29,13 +62,13 @@ class ShogiPiece:
     
     def must_promote(self, to_y):
         # Pawn and Lance must be promoted if they reach the furthest row
-        if self.name in ["Pion", "Lancer"]:
+        if self.kind in (PION, LANCER):
             if self.is_player and to_y == 0:
                 return True
             elif not self.is_player and to_y == 8:
                 return True
         # Knight must be promoted if it reaches the two furthest rows
-        elif self.name == "Knight":
+        elif self.kind == KNIGHT:
             if self.is_player and to_y <= 1:
                 return True
             elif not self.is_player and to_y >= 7:
@@ -45,6 +78,12 @@ class ShogiPiece:
     def promote(self):
         self.promoted = True
 
+    def get_kind(self):
+        # Kind used by the bitboard position, including promotion
+        if self.promoted:
+            return self.kind + PROMOTED
+        return self.kind
+
     def get_display_name(self):
         if self.promoted:
             return f"+{self.kanji}"
@@ -52,340 +91,2341 @@ class ShogiPiece:
 
     def get_display_romaji(self):
         if self.promoted:
-            if self.name == "Pion":
-                return "to"
-            elif self.name == "Lancer":
-                return "nkyo"
-            elif self.name == "Knight":
-                return "nkei"
-            elif self.name == "Silver":
-                return "ngin"
-            elif self.name == "Bishop":
-                return "uma"
-            elif self.name == "Rook":
-                return "ryu"
-            else:
-                return f"+{self.romaji}"
+            return self.promoted_romaji or f"+{self.romaji}"
         return self.romaji
 
-    def is_valid_move(self, board, from_x, from_y, to_x, to_y):
-        # Check if move is in the list of possible moves
-        moves = self.get_moves(board, from_x, from_y)
-        if (to_x, to_y) not in moves:
-            return False
-        
-        # Check if there is a piece of the same side at the destination
-        if board[to_y][to_x] is not None and board[to_y][to_x].is_player == self.is_player:
-            return False
-        
-        # Simulate the move to check if the king will be in check
-        temp_board = copy.deepcopy(board)
-        captured_piece = temp_board[to_y][to_x]
-        temp_board[to_y][to_x] = temp_board[from_y][from_x]
-        temp_board[from_y][from_x] = None
-        
-        # Find king position
-        king_pos = None
-        for y in range(9):
-            for x in range(9):
-                if temp_board[y][x] is not None and temp_board[y][x].name == "King" and temp_board[y][x].is_player == self.is_player:
-                    king_pos = (x, y)
-                    break
-            if king_pos:
-                break
-        
-        # Check if the king is in check after the move
-        if king_pos:
-            for y in range(9):
-                for x in range(9):
-                    if temp_board[y][x] is not None and temp_board[y][x].is_player != self.is_player:
-                        enemy_moves = temp_board[y][x].get_moves(temp_board, x, y)
-                        if king_pos in enemy_moves:
-                            return False
-        
-        return True
-
     def copy(self):
-        new_piece = type(self)(is_player=self.is_player)
+        new_piece = type(self)(self.is_player)
         new_piece.promoted = self.promoted
         new_piece.captured = self.captured
-        new_piece.can_be_promoted = self.can_be_promoted
         return new_piece
 
 class King(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("King", "王", "ou", is_player)
-        if is_player:
-            self.kanji = "玉"
-            self.romaji = "gyoku"
-        self.can_be_promoted = False  # King cannot be promoted
+    __slots__ = ()
+    kind = KING
+    name = "King"
+    can_be_promoted = False  # King cannot be promoted
 
-    def get_moves(self, board, x, y):
-        moves = []
-        directions = [
-            (-1, -1), (0, -1), (1, -1),
-            (-1, 0), (1, 0),
-            (-1, 1), (0, 1), (1, 1)
-        ]
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-        
-        return moves
+    # The player's king is written 玉, the AI's 王
+    @property
+    def kanji(self):
+        return "玉" if self.is_player else "王"
+
+    @property
+    def romaji(self):
+        return "gyoku" if self.is_player else "ou"
 
 class Rook(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Rook", "飛", "hi", is_player)
+    __slots__ = ()
+    kind = ROOK
+    name = "Rook"
+    kanji = "飛"
+    romaji = "hi"
+    promoted_romaji = "ryu"
 
-    def get_moves(self, board, x, y):
-        moves = []
-        directions = [(0, -1), (1, 0), (0, 1), (-1, 0)]  # Up, Right, Down, Left
+class Bishop(ShogiPiece):
+    __slots__ = ()
+    kind = BISHOP
+    name = "Bishop"
+    kanji = "角"
+    romaji = "kaku"
+    promoted_romaji = "uma"
+
+class Gold(ShogiPiece):
+    __slots__ = ()
+    kind = GOLD
+    name = "Gold"
+    kanji = "金"
+    romaji = "kin"
+    can_be_promoted = False  # Gold cannot be promoted
+
+class Silver(ShogiPiece):
+    __slots__ = ()
+    kind = SILVER
+    name = "Silver"
+    kanji = "銀"
+    romaji = "gin"
+    promoted_romaji = "ngin"
+
+class Knight(ShogiPiece):
+    __slots__ = ()
+    kind = KNIGHT
+    name = "Knight"
+    kanji = "桂"
+    romaji = "kei"
+    promoted_romaji = "nkei"
+
+class Lancer(ShogiPiece):
+    __slots__ = ()
+    kind = LANCER
+    name = "Lancer"
+    kanji = "香"
+    romaji = "kyo"
+    promoted_romaji = "nkyo"
+
+class Pion(ShogiPiece):
+    __slots__ = ()
+    kind = PION
+    name = "Pion"
+    kanji = "歩"
+    romaji = "fu"
+    promoted_romaji = "to"
+
+def initial_board():
+    # Create empty 9x9 board
+    board = [[None for _ in range(9)] for _ in range(9)]
+    
+    # Initial positions for player pieces (rows 6-8)
+    board[8][0] = Lancer(True)
+    board[8][1] = Knight(True)
+    board[8][2] = Silver(True)
+    board[8][3] = Gold(True)
+    board[8][4] = King(True)
+    board[8][5] = Gold(True)
+    board[8][6] = Silver(True)
+    board[8][7] = Knight(True)
+    board[8][8] = Lancer(True)
+
+    board[7][1] = Bishop(True)
+    board[7][7] = Rook(True)
+    
+    for i in range(9):
+        board[6][i] = Pion(True)
+    
+    # Initial positions for AI pieces (rows 0-2)
+    board[0][0] = Lancer(False)
+    board[0][1] = Knight(False)
+    board[0][2] = Silver(False)
+    board[0][3] = Gold(False)
+    board[0][4] = King(False)
+    board[0][5] = Gold(False)
+    board[0][6] = Silver(False)
+    board[0][7] = Knight(False)
+    board[0][8] = Lancer(False)
+    
+    board[1][1] = Rook(False)
+    board[1][7] = Bishop(False)
+    
+    for i in range(9):
+        board[2][i] = Pion(False)
         
-        for dx, dy in directions:
+    return board
+
+# Piece classes indexed by unpromoted kind
+PIECE_CLASSES = [Pion, Lancer, Knight, Silver, Bishop, Rook, Gold, King]
+
+def create_piece(side, kind):
+    piece = PIECE_CLASSES[kind & 7](side == PLAYER)
+    if kind & PROMOTED:
+        piece.promote()
+    return piece
+
+# Movement directions seen from the player's side (dy = -1 is forward).
+# AI pieces use the same directions mirrored vertically.
+ORTHOGONALS = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+DIAGONALS = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+GOLD_STEPS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (0, 1)]
+
+STEP_DIRECTIONS = {
+    PION: [(0, -1)],
+    KNIGHT: [(-1, -2), (1, -2)],
+    SILVER: [(-1, -1), (0, -1), (1, -1), (-1, 1), (1, 1)],
+    GOLD: GOLD_STEPS,
+    KING: DIAGONALS + ORTHOGONALS,
+    PION + PROMOTED: GOLD_STEPS,
+    LANCER + PROMOTED: GOLD_STEPS,
+    KNIGHT + PROMOTED: GOLD_STEPS,
+    SILVER + PROMOTED: GOLD_STEPS,
+    BISHOP + PROMOTED: ORTHOGONALS,  # Horse steps one square orthogonally
+    ROOK + PROMOTED: DIAGONALS,  # Dragon steps one square diagonally
+}
+
+SLIDE_DIRECTIONS = {
+    LANCER: [(0, -1)],
+    BISHOP: DIAGONALS,
+    ROOK: ORTHOGONALS,
+    BISHOP + PROMOTED: DIAGONALS,
+    ROOK + PROMOTED: ORTHOGONALS,
+}
+
+def iter_squares(bitboard):
+    # Yield the square index of every set bit, lowest first
+    while bitboard:
+        low = bitboard & -bitboard
+        yield low.bit_length() - 1
+        bitboard ^= low
+
+def build_step_moves():
+    # STEP_MOVES[side][kind][sq] is a tuple of the (x, y) squares a step piece
+    # reaches, the input of build_step_attacks
+    table = [[[()] * 81 for _ in range(PIECE_KINDS)] for _ in range(2)]
+    for side in (PLAYER, AI):
+        for kind, directions in STEP_DIRECTIONS.items():
+            for sq in range(81):
+                x, y = sq % 9, sq // 9
+                targets = []
+                for dx, dy in directions:
+                    if side == AI:
+                        dy = -dy
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < 9 and 0 <= ny < 9:
+                        targets.append((nx, ny))
+                table[side][kind][sq] = tuple(targets)
+    return table
+
+def build_step_attacks():
+    # STEP_ATTACKS[side][kind][sq] is the bitboard of the same squares as STEP_MOVES
+    return [[[sum(1 << (ny * 9 + nx) for nx, ny in targets) for targets in squares]
+             for squares in kinds] for kinds in STEP_MOVES]
+
+def build_ray_masks():
+    # RAY_MASKS[(dx, dy)][sq] holds every square from sq to the edge, sq excluded
+    rays = {}
+    for dx, dy in ORTHOGONALS + DIAGONALS:
+        masks = []
+        for sq in range(81):
+            x, y = sq % 9, sq // 9
+            mask = 0
             nx, ny = x + dx, y + dy
             while 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None:
-                    moves.append((nx, ny))
-                elif board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-                    break
-                else:
-                    break
+                mask |= 1 << (ny * 9 + nx)
                 nx, ny = nx + dx, ny + dy
-        
-        # Additional moves for Dragon (Promoted Rook)
-        if self.promoted:
-            diagonals = [(-1, -1), (1, -1), (1, 1), (-1, 1)]  # Diagonals
-            for dx, dy in diagonals:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < 9 and 0 <= ny < 9:
-                    if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                        moves.append((nx, ny))
-        
-        return moves
+            masks.append(mask)
+        rays[(dx, dy)] = masks
+    return rays
 
-class Bishop(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Bishop", "角", "kaku", is_player)
+def build_slide_rays():
+    # SLIDE_RAYS[side][kind] lists (masks, positive) for every ray of a slider.
+    # On a positive ray square numbers grow, so the nearest blocker is the lowest bit.
+    table = [[() for _ in range(PIECE_KINDS)] for _ in range(2)]
+    for side in (PLAYER, AI):
+        for kind, directions in SLIDE_DIRECTIONS.items():
+            rays = []
+            for dx, dy in directions:
+                if side == AI:
+                    dy = -dy
+                rays.append((RAY_MASKS[(dx, dy)], dy * 9 + dx > 0))
+            table[side][kind] = tuple(rays)
+    return table
 
-    def get_moves(self, board, x, y):
-        moves = []
-        directions = [(-1, -1), (1, -1), (1, 1), (-1, 1)]  # Diagonals
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            while 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None:
-                    moves.append((nx, ny))
-                elif board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-                    break
+STEP_MOVES = build_step_moves()
+STEP_ATTACKS = build_step_attacks()
+RAY_MASKS = build_ray_masks()
+SLIDE_RAYS = build_slide_rays()
+STEP_KINDS = [kind for kind in range(PIECE_KINDS) if kind in STEP_DIRECTIONS]
+SLIDE_KINDS = [kind for kind in range(PIECE_KINDS) if kind in SLIDE_DIRECTIONS]
+
+def build_rank_masks(rows):
+    mask = 0
+    for y in rows:
+        for x in range(9):
+            mask |= 1 << (y * 9 + x)
+    return mask
+
+FILE_MASKS = [sum(1 << (y * 9 + x) for y in range(9)) for x in range(9)]
+PROMOTION_ZONES = [build_rank_masks(range(0, 3)), build_rank_masks(range(6, 9))]
+
+# Squares where an unpromoted piece would have no move left: it must promote
+# when moving there and may not be dropped there.
+NO_MOVE_SQUARES = [[0] * PIECE_KINDS for _ in range(2)]
+NO_MOVE_SQUARES[PLAYER][PION] = NO_MOVE_SQUARES[PLAYER][LANCER] = build_rank_masks([0])
+NO_MOVE_SQUARES[PLAYER][KNIGHT] = build_rank_masks([0, 1])
+NO_MOVE_SQUARES[AI][PION] = NO_MOVE_SQUARES[AI][LANCER] = build_rank_masks([8])
+NO_MOVE_SQUARES[AI][KNIGHT] = build_rank_masks([7, 8])
+
+def build_pin_rays():
+    # PIN_RAYS[side] lists every ray from side's king as (masks, positive, kinds)
+    # with the enemy slider kinds that attack along it
+    table = [[], []]
+    for side in (PLAYER, AI):
+        enemy = side ^ 1
+        for (dx, dy), masks in RAY_MASKS.items():
+            if dx == 0 or dy == 0:
+                kinds = [ROOK, ROOK + PROMOTED]
+            else:
+                kinds = [BISHOP, BISHOP + PROMOTED]
+            # An enemy lance only attacks down the file from the enemy's side
+            if dx == 0 and dy == (-1 if enemy == AI else 1):
+                kinds.append(LANCER)
+            table[side].append((masks, dy * 9 + dx > 0, kinds))
+    return table
+
+PIN_RAYS = build_pin_rays()
+
+def nearest_square(bitboard, positive):
+    # First set square along a ray: lowest bit on a positive ray, highest otherwise
+    if positive:
+        return (bitboard & -bitboard).bit_length() - 1
+    return bitboard.bit_length() - 1
+
+def ray_attacks(masks, positive, sq, occupied):
+    attacks = masks[sq]
+    blockers = attacks & occupied
+    if blockers:
+        if positive:
+            blocker = (blockers & -blockers).bit_length() - 1
+        else:
+            blocker = blockers.bit_length() - 1
+        # Cut the ray behind the first blocker, the blocker itself stays attacked
+        attacks ^= masks[blocker]
+    return attacks
+
+# Moves are packed into ints: bits 0-6 from square (DROP_BASE + kind for
+# drops), bits 7-13 to square and bit 14 set when the piece promotes.
+DROP_BASE = 81
+PROMOTE_FLAG = 1 << 14
+
+def encode_move(from_sq, to_sq, promote=False):
+    move = from_sq | to_sq << 7
+    if promote:
+        move |= PROMOTE_FLAG
+    return move
+
+def encode_drop(kind, to_sq):
+    return DROP_BASE + kind | to_sq << 7
+
+# Piece values in the units of get_piece_value, indexed by kind
+PIECE_VALUES = [1, 3, 3, 5, 8, 10, 6, 100, 3, 5, 5, 7, 10, 12, 0, 0]
+# Kinds from least to most valuable, for picking the next attacker in see
+SEE_ORDER = sorted(range(PIECE_KINDS), key=lambda kind: PIECE_VALUES[kind])
+
+# Names used in the evaluation config file, promoted kinds get a "+"
+PIECE_NAMES = ["Pion", "Lancer", "Knight", "Silver", "Bishop", "Rook", "Gold", "King"]
+KIND_NAMES = {kind: name for kind, name in enumerate(PIECE_NAMES)}
+KIND_NAMES.update({kind + PROMOTED: "+" + PIECE_NAMES[kind] for kind in range(GOLD)})
+
+# Piece-square bonuses per rank, seen from the player's side (rank 0 is the far side)
+DEFAULT_RANK_BONUS = {
+    PION: [0, 30, 25, 20, 10, 5, 0, 0, 0],
+    KNIGHT: [0, 0, 20, 15, 10, 5, 0, -5, -10],
+    SILVER: [0, 10, 20, 20, 15, 10, 5, 0, -5],
+    GOLD: [-10, 0, 5, 5, 5, 10, 10, 10, 5],
+    KING: [-40, -40, -30, -20, -15, -10, 0, 10, 20],
+    ROOK: [15, 15, 15, 5, 0, 0, 0, 0, 0],
+    PION + PROMOTED: [10, 15, 20, 15, 10, 5, 0, 0, 0],
+    LANCER + PROMOTED: [10, 15, 20, 15, 10, 5, 0, 0, 0],
+    KNIGHT + PROMOTED: [10, 15, 20, 15, 10, 5, 0, 0, 0],
+    SILVER + PROMOTED: [10, 15, 20, 15, 10, 5, 0, 0, 0],
+}
+
+EVAL_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shogi_eval.json")
+
+class Evaluator:
+    # Material, piece-square and hand values in hundredths of a Pion. The
+    # tables are flattened so a position can add and subtract them per move.
+    def __init__(self, config=None):
+        self.piece_values = [value * 100 for value in PIECE_VALUES]
+        self.piece_values[KING] = 0  # Both sides always have one
+        # A piece in hand can be dropped anywhere, so it is worth a bit more
+        self.hand_values = [value * 115 for value in PIECE_VALUES[:8]]
+        self.piece_square = [[0] * 81 for _ in range(PIECE_KINDS)]
+        for kind, ranks in DEFAULT_RANK_BONUS.items():
+            self.piece_square[kind] = [ranks[sq // 9] for sq in range(81)]
+        if config:
+            self.apply_config(config)
+        self.build_tables()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def apply_config(self, config):
+        # {"piece_values": {"Pion": 100, "+Rook": 1200}, "hand_values": {"Pion": 115},
+        #  "piece_square": {"Pion": [9 values per rank] or [81 values per square]}}
+        kinds = {name: kind for kind, name in KIND_NAMES.items()}
+        for name, value in config.get("piece_values", {}).items():
+            self.piece_values[kinds[name]] = value
+        for name, value in config.get("hand_values", {}).items():
+            self.hand_values[kinds[name]] = value
+        for name, values in config.get("piece_square", {}).items():
+            if len(values) == 9:
+                values = [values[sq // 9] for sq in range(81)]
+            elif len(values) != 81:
+                raise ValueError(f"piece_square for {name} needs 9 or 81 values")
+            self.piece_square[kinds[name]] = list(values)
+
+    def build_tables(self):
+        # square_scores[code][sq] and hand_scores[side][kind] are signed from the
+        # player's side; AI pieces read the piece-square table rotated by 180 degrees.
+        self.square_scores = [[0] * 81 for _ in range(32)]
+        for kind in range(PIECE_KINDS):
+            for sq in range(81):
+                self.square_scores[PLAYER << 4 | kind][sq] = self.piece_values[kind] + self.piece_square[kind][sq]
+                self.square_scores[AI << 4 | kind][sq] = -(self.piece_values[kind] + self.piece_square[kind][80 - sq])
+        self.hand_scores = [self.hand_values[:], [-value for value in self.hand_values]]
+
+    def evaluate(self, position):
+        # Full recount from the player's side, the position normally keeps this incrementally
+        score = 0
+        for sq, code in enumerate(position.squares):
+            if code is not None:
+                score += self.square_scores[code][sq]
+        for side in (PLAYER, AI):
+            for kind, count in enumerate(position.hands[side]):
+                score += self.hand_scores[side][kind] * count
+        return score
+
+def load_evaluator(path=EVAL_CONFIG_FILE):
+    if os.path.exists(path):
+        return Evaluator.from_file(path)
+    return Evaluator()
+
+DEFAULT_EVALUATOR = load_evaluator()
+
+# Zobrist keys, from a fixed seed so hashes are the same on every run
+def build_zobrist_keys():
+    rng = random.Random(20250527)
+    pieces = [[rng.getrandbits(64) for _ in range(81)] for _ in range(32)]
+    hands = [[[rng.getrandbits(64) for _ in range(19)] for _ in range(8)] for _ in range(2)]
+    sides = [0, rng.getrandbits(64)]
+    return pieces, hands, sides
+
+# ZOBRIST_PIECES[code][sq], ZOBRIST_HANDS[side][kind][count] (one key per
+# piece in hand, so adding the n-th piece XORs key n) and ZOBRIST_SIDE[side]
+ZOBRIST_PIECES, ZOBRIST_HANDS, ZOBRIST_SIDE = build_zobrist_keys()
+
+# SFEN letters indexed by kind and the usual order of pieces in hand
+SFEN_LETTERS = "PLNSBRGK"
+SFEN_HAND_ORDER = [ROOK, BISHOP, GOLD, SILVER, KNIGHT, LANCER, PION]
+START_SFEN = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
+
+# Bits per hand count in the packed encoding: up to 18 pawns, 4 of L/N/S/G, 2 of B/R
+HAND_BITS = [(PION, 5), (LANCER, 3), (KNIGHT, 3), (SILVER, 3), (GOLD, 3), (BISHOP, 2), (ROOK, 2)]
+PACKED_SIZE = 56  # 81 * 5 + 2 * 21 + 1 = 448 bits
+
+class Position:
+    # Compact position: one 81-bit bitboard per side and kind, a square list
+    # holding piece codes (side << 4 | kind) and hand counts per side.
+    def __init__(self):
+        self.squares = [None] * 81
+        self.bitboards = [[0] * PIECE_KINDS for _ in range(2)]
+        self.occupied = [0, 0]
+        self.hands = [[0] * 8 for _ in range(2)]  # Indexed by kind, King only if captured
+        self.side_to_move = PLAYER
+        self.king_squares = [None, None]
+        self.key = 0  # Zobrist key of the board and hands, see hash_key for the side to move
+        self.evaluator = DEFAULT_EVALUATOR
+        self.square_scores = self.evaluator.square_scores
+        self.hand_scores = self.evaluator.hand_scores
+        self.score = 0  # Evaluation from the player's side, kept up to date on every change
+
+    @classmethod
+    def from_board(cls, board, player_captures=(), ai_captures=(), player_turn=True):
+        position = cls()
+        for y in range(9):
+            for x in range(9):
+                piece = board[y][x]
+                if piece is not None:
+                    position.put_piece(y * 9 + x, PLAYER if piece.is_player else AI, piece.get_kind())
+        for piece in player_captures:
+            position.hands[PLAYER][piece.kind] += 1
+        for piece in ai_captures:
+            position.hands[AI][piece.kind] += 1
+        position.side_to_move = PLAYER if player_turn else AI
+        position.key = position.compute_key()
+        position.score = position.evaluator.evaluate(position)
+        return position
+
+    def copy(self):
+        position = Position.__new__(Position)
+        position.squares = self.squares[:]
+        position.bitboards = [self.bitboards[PLAYER][:], self.bitboards[AI][:]]
+        position.occupied = self.occupied[:]
+        position.hands = [self.hands[PLAYER][:], self.hands[AI][:]]
+        position.side_to_move = self.side_to_move
+        position.king_squares = self.king_squares[:]
+        position.key = self.key
+        position.evaluator = self.evaluator
+        position.square_scores = self.square_scores
+        position.hand_scores = self.hand_scores
+        position.score = self.score
+        return position
+
+    def use_evaluator(self, evaluator):
+        self.evaluator = evaluator
+        self.square_scores = evaluator.square_scores
+        self.hand_scores = evaluator.hand_scores
+        self.score = evaluator.evaluate(self)
+
+    def to_sfen(self, move_number=1):
+        # The player is Black (upper case, moves first), the AI is White
+        ranks = []
+        for y in range(9):
+            rank = ""
+            empty = 0
+            for x in range(9):
+                code = self.squares[y * 9 + x]
+                if code is None:
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                kind = code & 15
+                letter = SFEN_LETTERS[kind & 7]
+                if code >> 4 == AI:
+                    letter = letter.lower()
+                rank += "+" + letter if kind & PROMOTED else letter
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        hand = ""
+        for side in (PLAYER, AI):
+            for kind in SFEN_HAND_ORDER:
+                count = self.hands[side][kind]
+                if count:
+                    letter = SFEN_LETTERS[kind] if side == PLAYER else SFEN_LETTERS[kind].lower()
+                    hand += (str(count) if count > 1 else "") + letter
+        side = "b" if self.side_to_move == PLAYER else "w"
+        return f"{'/'.join(ranks)} {side} {hand or '-'} {move_number}"
+
+    @classmethod
+    def from_sfen(cls, sfen):
+        fields = sfen.split()
+        if len(fields) < 3:
+            raise ValueError(f"SFEN needs board, side and hand fields: {sfen!r}")
+        ranks = fields[0].split("/")
+        if len(ranks) != 9:
+            raise ValueError(f"SFEN board needs 9 ranks: {fields[0]!r}")
+        position = cls()
+        for y, rank in enumerate(ranks):
+            x = 0
+            promoted = False
+            for char in rank:
+                if char.isdigit():
+                    x += int(char)
+                elif char == "+":
+                    promoted = True
+                elif char.upper() in SFEN_LETTERS and x < 9:
+                    kind = SFEN_LETTERS.index(char.upper())
+                    if promoted:
+                        if kind >= GOLD:
+                            raise ValueError(f"{char} cannot be promoted")
+                        kind |= PROMOTED
+                    position.put_piece(y * 9 + x, PLAYER if char.isupper() else AI, kind)
+                    x += 1
+                    promoted = False
                 else:
-                    break
-                nx, ny = nx + dx, ny + dy
-        
-        # Additional moves for Horse (Promoted Bishop)
-        if self.promoted:
-            orthogonals = [(0, -1), (1, 0), (0, 1), (-1, 0)]  # Up, Right, Down, Left
-            for dx, dy in orthogonals:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < 9 and 0 <= ny < 9:
-                    if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                        moves.append((nx, ny))
-        
-        return moves
+                    raise ValueError(f"Bad SFEN rank {rank!r}")
+            if x != 9:
+                raise ValueError(f"SFEN rank {rank!r} does not have 9 files")
+        if fields[1] not in ("b", "w"):
+            raise ValueError(f"Bad SFEN side to move {fields[1]!r}")
+        position.side_to_move = PLAYER if fields[1] == "b" else AI
+        if fields[2] != "-":
+            count = ""
+            for char in fields[2]:
+                if char.isdigit():
+                    count += char
+                elif char.upper() in SFEN_LETTERS[:HAND_KINDS]:
+                    side = PLAYER if char.isupper() else AI
+                    position.hands[side][SFEN_LETTERS.index(char.upper())] += int(count or 1)
+                    count = ""
+                else:
+                    raise ValueError(f"Bad SFEN hand {fields[2]!r}")
+        position.key = position.compute_key()
+        position.score = position.evaluator.evaluate(position)
+        return position
 
-class Gold(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Gold", "金", "kin", is_player)
-        self.can_be_promoted = False  # Gold cannot be promoted
+    def pack(self):
+        # Fixed 56 bytes: 5 bits per square (0 empty, else side * 14 + kind + 1),
+        # hand counts in HAND_BITS widths for both sides and 1 bit for the side to move.
+        # Used for worker processes, hashing and storing positions on disk.
+        value = 0
+        shift = 0
+        for code in self.squares:
+            if code is not None:
+                value |= ((code >> 4) * 14 + (code & 15) + 1) << shift
+            shift += 5
+        for side in (PLAYER, AI):
+            for kind, bits in HAND_BITS:
+                value |= self.hands[side][kind] << shift
+                shift += bits
+        value |= self.side_to_move << shift
+        return value.to_bytes(PACKED_SIZE, "little")
 
-    def get_moves(self, board, x, y):
-        moves = []
-        if self.is_player:
-            directions = [
-                (-1, -1), (0, -1), (1, -1),
-                (-1, 0), (1, 0),
-                (0, 1)
-            ]
+    @classmethod
+    def unpack(cls, data):
+        value = int.from_bytes(data, "little")
+        position = cls()
+        for sq in range(81):
+            piece = value & 31
+            value >>= 5
+            if piece:
+                position.put_piece(sq, (piece - 1) // 14, (piece - 1) % 14)
+        for side in (PLAYER, AI):
+            for kind, bits in HAND_BITS:
+                position.hands[side][kind] = value & ((1 << bits) - 1)
+                value >>= bits
+        position.side_to_move = value & 1
+        position.key = position.compute_key()
+        position.score = position.evaluator.evaluate(position)
+        return position
+
+    def compute_key(self):
+        key = 0
+        for sq, code in enumerate(self.squares):
+            if code is not None:
+                key ^= ZOBRIST_PIECES[code][sq]
+        for side in (PLAYER, AI):
+            for kind, count in enumerate(self.hands[side]):
+                for n in range(1, count + 1):
+                    key ^= ZOBRIST_HANDS[side][kind][n]
+        return key
+
+    def hash_key(self):
+        # Side to move is folded in here, so callers may set side_to_move freely
+        return self.key ^ ZOBRIST_SIDE[self.side_to_move]
+
+    def to_board(self):
+        board = [[None for _ in range(9)] for _ in range(9)]
+        for sq, code in enumerate(self.squares):
+            if code is not None:
+                board[sq // 9][sq % 9] = create_piece(code >> 4, code & 15)
+        player_captures = []
+        ai_captures = []
+        for kind in range(HAND_KINDS):
+            player_captures += [create_piece(PLAYER, kind) for _ in range(self.hands[PLAYER][kind])]
+            ai_captures += [create_piece(AI, kind) for _ in range(self.hands[AI][kind])]
+        return board, player_captures, ai_captures
+
+    def put_piece(self, sq, side, kind):
+        bit = 1 << sq
+        code = side << 4 | kind
+        self.squares[sq] = code
+        self.key ^= ZOBRIST_PIECES[code][sq]
+        self.score += self.square_scores[code][sq]
+        self.bitboards[side][kind] |= bit
+        self.occupied[side] |= bit
+        if kind == KING:
+            self.king_squares[side] = sq
+
+    def remove_piece(self, sq):
+        code = self.squares[sq]
+        bit = 1 << sq
+        side = code >> 4
+        self.squares[sq] = None
+        self.key ^= ZOBRIST_PIECES[code][sq]
+        self.score -= self.square_scores[code][sq]
+        self.bitboards[side][code & 15] ^= bit
+        self.occupied[side] ^= bit
+        if code & 15 == KING:
+            self.king_squares[side] = None
+        return code
+
+    def make_move(self, move):
+        # Play an encoded move in place and return its undo record
+        from_sq = move & 127
+        to_sq = move >> 7 & 127
+        side = self.side_to_move
+        hand = self.hands[side]
+        key = self.key
+        score = self.score
+        captured = self.squares[to_sq]
+        if captured is not None:
+            self.remove_piece(to_sq)
+            hand[captured & 7] += 1
+            self.key ^= ZOBRIST_HANDS[side][captured & 7][hand[captured & 7]]
+            self.score += self.hand_scores[side][captured & 7]
+        if from_sq >= DROP_BASE:
+            kind = from_sq - DROP_BASE
+            moved = side << 4 | kind
+            self.key ^= ZOBRIST_HANDS[side][kind][hand[kind]]
+            self.score -= self.hand_scores[side][kind]
+            hand[kind] -= 1
         else:
-            directions = [
-                (-1, 1), (0, 1), (1, 1),
-                (-1, 0), (1, 0),
-                (0, -1)
-            ]
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-        
-        return moves
+            moved = self.remove_piece(from_sq)
+            kind = moved & 15
+            if move & PROMOTE_FLAG:
+                kind |= PROMOTED
+        self.put_piece(to_sq, side, kind)
+        self.side_to_move = side ^ 1
+        return move, moved, captured, key, score
 
-class Silver(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Silver", "銀", "gin", is_player)
+    def unmake_move(self, undo):
+        move, moved, captured, key, score = undo
+        from_sq = move & 127
+        to_sq = move >> 7 & 127
+        side = moved >> 4
+        self.remove_piece(to_sq)
+        if from_sq >= DROP_BASE:
+            self.hands[side][from_sq - DROP_BASE] += 1
+        else:
+            self.put_piece(from_sq, side, moved & 15)
+        if captured is not None:
+            self.put_piece(to_sq, captured >> 4, captured & 15)
+            self.hands[side][captured & 7] -= 1
+        self.side_to_move = side
+        self.key = key
+        self.score = score
 
-    def get_moves(self, board, x, y):
-        moves = []
-        if not self.promoted:
-            if self.is_player:
-                directions = [
-                    (-1, -1), (0, -1), (1, -1),
-                    (-1, 1), (1, 1)
-                ]
-            else:
-                directions = [
-                    (-1, 1), (0, 1), (1, 1),
-                    (-1, -1), (1, -1)
-                ]
+    def king_square(self, side):
+        return self.king_squares[side]
+
+    def is_in_check(self, side):
+        king = self.king_squares[side]
+        return king is not None and self.attackers_to(king, side ^ 1) != 0
+
+    def attacks_from(self, sq):
+        # Squares attacked by the piece on sq, including squares of its own side
+        code = self.squares[sq]
+        if code is None:
+            return 0
+        side = code >> 4
+        kind = code & 15
+        attacks = STEP_ATTACKS[side][kind][sq]
+        rays = SLIDE_RAYS[side][kind]
+        if rays:
+            occupied = self.occupied[PLAYER] | self.occupied[AI]
+            for masks, positive in rays:
+                attacks |= ray_attacks(masks, positive, sq, occupied)
+        return attacks
+
+    def attackers_to(self, sq, side, occupied=None):
+        # Pieces of side attacking sq. Every piece is left/right symmetric, so
+        # looking out from sq with the other side's tables finds them. Sliders
+        # look through anything missing from occupied (used by see).
+        boards = self.bitboards[side]
+        other = 1 - side
+        attackers = 0
+        for kind in STEP_KINDS:
+            if boards[kind]:
+                attackers |= STEP_ATTACKS[other][kind][sq] & boards[kind]
+        if occupied is None:
+            occupied = self.occupied[PLAYER] | self.occupied[AI]
+        for kind in SLIDE_KINDS:
+            if boards[kind]:
+                for masks, positive in SLIDE_RAYS[other][kind]:
+                    attackers |= ray_attacks(masks, positive, sq, occupied) & boards[kind]
+        return attackers
+
+    def see(self, move):
+        # Static exchange evaluation: material won by move once both sides have
+        # recaptured on its target square with their least valuable attacker,
+        # each free to stop when going on would lose. Pins are ignored.
+        from_sq = move & 127
+        to_sq = move >> 7 & 127
+        side = self.side_to_move
+        occupied = self.occupied[PLAYER] | self.occupied[AI]
+        if from_sq >= DROP_BASE:
+            kind = from_sq - DROP_BASE
         else:
-            # Promoted Silver moves like Gold
-            if self.is_player:
-                directions = [
-                    (-1, -1), (0, -1), (1, -1),
-                    (-1, 0), (1, 0),
-                    (0, 1)
-                ]
+            kind = self.squares[from_sq] & 15
+            occupied ^= 1 << from_sq
+        if move & PROMOTE_FLAG:
+            kind |= PROMOTED
+        victim = self.squares[to_sq]
+        gains = [PIECE_VALUES[victim & 15] if victim is not None else 0]
+        on_square = PIECE_VALUES[kind]
+        side ^= 1
+        while True:
+            attackers = self.attackers_to(to_sq, side, occupied) & occupied
+            if not attackers:
+                break
+            boards = self.bitboards[side]
+            for kind in SEE_ORDER:
+                if boards[kind] & attackers:
+                    attacker = boards[kind] & attackers
+                    break
+            gains.append(on_square - gains[-1])
+            on_square = PIECE_VALUES[kind]
+            occupied ^= attacker & -attacker
+            side ^= 1
+        while len(gains) > 1:
+            last = gains.pop()
+            gains[-1] = -max(-gains[-1], last)
+        return gains[0]
+
+    def generate_captures(self):
+        # Pseudo-legal captures and promotions of the side to move, for the quiescence search
+        side = self.side_to_move
+        own = self.occupied[side]
+        enemy = self.occupied[side ^ 1]
+        zone = PROMOTION_ZONES[side]
+        moves = []
+        for from_sq in iter_squares(own):
+            kind = self.squares[from_sq] & 15
+            targets = self.attacks_from(from_sq) & ~own
+            if kind < GOLD and (zone >> from_sq & 1 or targets & zone):
+                no_move = NO_MOVE_SQUARES[side][kind]
+                for to_sq in iter_squares(targets):
+                    move = from_sq | to_sq << 7
+                    if zone >> from_sq & 1 or zone >> to_sq & 1:
+                        moves.append(move | PROMOTE_FLAG)
+                        if enemy >> to_sq & 1 and not no_move >> to_sq & 1:
+                            moves.append(move)
+                    elif enemy >> to_sq & 1:
+                        moves.append(move)
             else:
-                directions = [
-                    (-1, 1), (0, 1), (1, 1),
-                    (-1, 0), (1, 0),
-                    (0, -1)
-                ]
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-        
+                for to_sq in iter_squares(targets & enemy):
+                    moves.append(from_sq | to_sq << 7)
         return moves
 
-class Knight(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Knight", "桂", "kei", is_player)
-
-    def get_moves(self, board, x, y):
+    def generate_moves(self):
+        # Pseudo-legal moves for the side to move; they may leave the own king in check
+        side = self.side_to_move
+        own = self.occupied[side]
+        zone = PROMOTION_ZONES[side]
         moves = []
-        if not self.promoted:
-            if self.is_player:
-                directions = [(-1, -2), (1, -2)]  # L-shape forward
-            else:
-                directions = [(-1, 2), (1, 2)]  # L-shape forward
-        else:
-            # Promoted Knight moves like Gold
-            if self.is_player:
-                directions = [
-                    (-1, -1), (0, -1), (1, -1),
-                    (-1, 0), (1, 0),
-                    (0, 1)
-                ]
+        for from_sq in iter_squares(own):
+            kind = self.squares[from_sq] & 15
+            targets = self.attacks_from(from_sq) & ~own
+            if kind < GOLD and (zone >> from_sq & 1 or targets & zone):
+                no_move = NO_MOVE_SQUARES[side][kind]
+                for to_sq in iter_squares(targets):
+                    move = from_sq | to_sq << 7
+                    if zone >> from_sq & 1 or zone >> to_sq & 1:
+                        moves.append(move | PROMOTE_FLAG)
+                        if not no_move >> to_sq & 1:
+                            moves.append(move)
+                    else:
+                        moves.append(move)
             else:
-                directions = [
-                    (-1, 1), (0, 1), (1, 1),
-                    (-1, 0), (1, 0),
-                    (0, -1)
-                ]
-        
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
-        
+                for to_sq in iter_squares(targets):
+                    moves.append(from_sq | to_sq << 7)
+        
+        hand = self.hands[side]
+        empty = ALL_SQUARES & ~(own | self.occupied[side ^ 1])
+        for kind in range(HAND_KINDS):
+            if hand[kind]:
+                targets = empty & ~NO_MOVE_SQUARES[side][kind]
+                if kind == PION:
+                    # Nifu: no second unpromoted pawn on a file
+                    targets &= ~self.pawn_files(side)
+                for to_sq in iter_squares(targets):
+                    moves.append(DROP_BASE + kind | to_sq << 7)
         return moves
 
-class Lancer(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Lancer", "香", "kyo", is_player)
+    def pawn_files(self, side):
+        # Mask of every file holding an unpromoted pawn of side
+        files = 0
+        for sq in iter_squares(self.bitboards[side][PION]):
+            files |= FILE_MASKS[sq % 9]
+        return files
 
-    def get_moves(self, board, x, y):
-        moves = []
-        if not self.promoted:
-            if self.is_player:
-                dy = -1  # Straight forward
+    def pinned_pieces(self, side):
+        # Pieces of side that shield their king from an enemy slider
+        king = self.king_squares[side]
+        if king is None:
+            return 0
+        enemy_boards = self.bitboards[side ^ 1]
+        own = self.occupied[side]
+        occupied = own | self.occupied[side ^ 1]
+        pinned = 0
+        for masks, positive, kinds in PIN_RAYS[side]:
+            ray = masks[king]
+            sliders = 0
+            for kind in kinds:
+                sliders |= enemy_boards[kind]
+            if not sliders & ray:
+                continue
+            blockers = ray & occupied
+            first = nearest_square(blockers, positive)
+            if not own >> first & 1:
+                continue
+            blockers ^= 1 << first
+            if blockers and sliders >> nearest_square(blockers, positive) & 1:
+                pinned |= 1 << first
+        return pinned
+
+MATE_SCORE = 100000
+INFINITE = 1000000
+
+def evaluate(position):
+    # The position keeps its score up to date from the player's side
+    if position.side_to_move == AI:
+        return -position.score
+    return position.score
+
+# Root move lists at least this long are scored with NumPy when it is installed
+BATCH_SCORE_MIN_MOVES = 128
+if np is not None:
+    # Distance from every king square to every move origin; drop origins (DROP_BASE
+    # and up) are far from everything so they never count as stepping closer
+    SQUARE_DISTANCES = np.full((81, DROP_BASE + HAND_KINDS), 99, dtype=np.int32)
+    for king_sq in range(81):
+        for sq in range(81):
+            SQUARE_DISTANCES[king_sq, sq] = abs(sq % 9 - king_sq % 9) + abs(sq // 9 - king_sq // 9)
+    # Drop score per king square and target square
+    DROP_SCORES = 2 + np.maximum(0, 9 - SQUARE_DISTANCES)
+
+def score_root_moves(position, moves):
+    # Static scores of the original one-ply AI: exchange value x10 (see), +5 for a
+    # promotion, +3 for stepping closer to the enemy king and 2 + closeness for drops.
+    if np is not None and len(moves) >= BATCH_SCORE_MIN_MOVES:
+        return score_root_moves_batch(position, moves)
+    side = position.side_to_move
+    king = position.king_squares[side ^ 1]
+    scores = []
+    for move in moves:
+        from_sq = move & 127
+        to_sq = move >> 7 & 127
+        score = 0
+        if from_sq >= DROP_BASE:
+            score = 2
+            if king is not None:
+                dist = abs(to_sq % 9 - king % 9) + abs(to_sq // 9 - king // 9)
+                score += max(0, 9 - dist)
+        else:
+            if position.squares[to_sq] is not None:
+                score += position.see(move) * 10
+            if move & PROMOTE_FLAG:
+                score += 5
+            if position.squares[from_sq] & 15 != KING and king is not None:
+                curr_dist = abs(from_sq % 9 - king % 9) + abs(from_sq // 9 - king // 9)
+                new_dist = abs(to_sq % 9 - king % 9) + abs(to_sq // 9 - king // 9)
+                if new_dist < curr_dist:
+                    score += 3
+        scores.append(score)
+    return scores
+
+def score_root_moves_batch(position, moves):
+    # score_root_moves in a few array operations; only captures, which need an
+    # exchange evaluation each, are still scored one by one
+    king = position.king_squares[position.side_to_move ^ 1]
+    codes = np.array(moves, dtype=np.int32)
+    from_sq = codes & 127
+    to_sq = codes >> 7 & 127
+    drops = from_sq >= DROP_BASE
+    # Piece codes by square, -1 for empty squares and drop origins
+    board = np.array([-1 if code is None else code for code in position.squares] + [-1] * HAND_KINDS,
+                     dtype=np.int32)
+    scores = np.where(codes & PROMOTE_FLAG, 5, 0)
+    if king is None:
+        scores[drops] = 2
+    else:
+        distances = SQUARE_DISTANCES[king]
+        closer = ~drops & (board[from_sq] & 15 != KING) & (distances[to_sq] < distances[from_sq])
+        scores += closer * 3
+        scores[drops] = DROP_SCORES[king][to_sq[drops]]
+    for index in np.flatnonzero(~drops & (board[to_sq] >= 0)).tolist():
+        scores[index] += position.see(moves[index]) * 10
+    return scores.tolist()
+
+def generate_legal_moves(position, side=None, stats=None):
+    # Every legal move of side (default: the side to move): board moves with their
+    # promotion variants and drops, nifu and dead-square rules applied by the
+    # generator. Check and pins are worked out once, so only king moves, moves of
+    # pinned pieces and replies to a check are verified by playing them; those
+    # verifications count as legality checks in stats.
+    saved_side = position.side_to_move
+    if side is None:
+        side = saved_side
+    position.side_to_move = side
+    try:
+        moves = position.generate_moves()
+        king = position.king_squares[side]
+        if king is None:
+            return moves
+        in_check = position.is_in_check(side)
+        pinned = position.pinned_pieces(side)
+        # The only square where a dropped pawn gives check (uchifuzume test)
+        enemy_king = position.king_squares[side ^ 1]
+        pawn_check = STEP_ATTACKS[side ^ 1][PION][enemy_king] if enemy_king is not None else 0
+        legal = []
+        checks = 0
+        for move in moves:
+            from_sq = move & 127
+            if in_check or from_sq == king or (from_sq < DROP_BASE and pinned >> from_sq & 1):
+                checks += 1
+                undo = position.make_move(move)
+                safe = not position.is_in_check(side)
+                position.unmake_move(undo)
+                if not safe:
+                    continue
+            if from_sq == DROP_BASE + PION and pawn_check >> (move >> 7 & 127) & 1:
+                checks += 1
+                if is_pawn_drop_mate(position, move, stats):
+                    continue
+            legal.append(move)
+        if stats is not None:
+            stats.legality_checks += checks
+        return legal
+    finally:
+        position.side_to_move = saved_side
+
+def is_pawn_drop_mate(position, move, stats=None):
+    # Uchifuzume: a pawn drop may give check but not checkmate
+    undo = position.make_move(move)
+    mated = not generate_legal_moves(position, stats=stats)
+    position.unmake_move(undo)
+    return mated
+
+class MoveOrderer:
+    # Orders moves as: transposition table move, captures by MVV-LVA, killer
+    # moves of the ply, quiet board moves by history, then drops by history.
+    TT_MOVE = 1 << 30
+    CAPTURE = 1 << 26
+    KILLER = 1 << 24
+    QUIET = 1 << 22
+    DROP = 0
+    HISTORY_LIMIT = (1 << 22) - 1
+
+    def __init__(self, max_depth=64):
+        self.killers = [[0, 0] for _ in range(max_depth + 2)]
+        self.history = [[0] * 81 for _ in range(32)]  # [piece code][to square]
+
+    def new_search(self):
+        # Killers only make sense within one search, history is aged instead
+        for killers in self.killers:
+            killers[0] = killers[1] = 0
+        for row in self.history:
+            for sq in range(81):
+                row[sq] >>= 1
+
+    def order(self, position, moves, ply, tt_move=0):
+        squares = position.squares
+        history = self.history
+        killer_1, killer_2 = self.killers[ply]
+        side = position.side_to_move
+        scores = []
+        for move in moves:
+            from_sq = move & 127
+            to_sq = move >> 7 & 127
+            victim = squares[to_sq]
+            if move == tt_move:
+                score = self.TT_MOVE
+            elif victim is not None:
+                # Most valuable victim first, least valuable attacker breaks ties
+                score = self.CAPTURE + PIECE_VALUES[victim & 15] * 256 - PIECE_VALUES[squares[from_sq] & 15]
+            elif move == killer_1:
+                score = self.KILLER + 1
+            elif move == killer_2:
+                score = self.KILLER
+            elif from_sq >= DROP_BASE:
+                score = self.DROP + history[side << 4 | from_sq - DROP_BASE][to_sq]
             else:
-                dy = 1  # Straight forward
-            
-            nx, ny = x, y + dy
-            while 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None:
-                    moves.append((nx, ny))
-                elif board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
+                score = self.QUIET + history[squares[from_sq]][to_sq]
+            scores.append(score)
+        return [move for _, move in sorted(zip(scores, moves), reverse=True)]
+
+    def record_cutoff(self, position, move, ply, depth):
+        # Called with the move taken back; captures are already ordered well
+        to_sq = move >> 7 & 127
+        if position.squares[to_sq] is not None:
+            return
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        from_sq = move & 127
+        if from_sq >= DROP_BASE:
+            piece = position.side_to_move << 4 | from_sq - DROP_BASE
+        else:
+            piece = position.squares[from_sq]
+        history = self.history[piece]
+        history[to_sq] = min(history[to_sq] + depth * depth, self.HISTORY_LIMIT)
+
+class SearchTimeout(Exception):
+    pass
+
+# Transposition table entry bounds
+EXACT, LOWER, UPPER = 0, 1, 2
+
+def score_to_tt(score, ply):
+    # Mate scores are stored relative to the node, not to the root
+    if score > MATE_SCORE - 1000:
+        return score + ply
+    if score < -MATE_SCORE + 1000:
+        return score - ply
+    return score
+
+def score_from_tt(score, ply):
+    if score > MATE_SCORE - 1000:
+        return score - ply
+    if score < -MATE_SCORE + 1000:
+        return score + ply
+    return score
+
+class TranspositionTable:
+    # Fixed-size table kept in flat typed arrays: key, move, score, depth,
+    # bound and the age of the search that wrote the entry.
+    ENTRY_BYTES = 19
+
+    def __init__(self, memory_mb=16):
+        self.memory_mb = memory_mb
+        entries = 1
+        while entries * 2 * self.ENTRY_BYTES <= memory_mb * 1024 * 1024:
+            entries *= 2
+        self.size = entries
+        self.mask = entries - 1
+        self.keys = array('Q', [0]) * entries
+        self.moves = array('I', [0]) * entries
+        self.scores = array('i', [0]) * entries
+        self.depths = array('b', [0]) * entries
+        self.flags = array('B', [0]) * entries
+        self.ages = array('B', [0]) * entries
+        self.age = 0
+
+    def new_search(self):
+        # Entries of earlier searches stay usable but may always be replaced
+        self.age = (self.age + 1) & 255
+
+    def clear(self):
+        self.__init__(self.memory_mb)
+
+    def probe(self, key):
+        index = key & self.mask
+        if self.keys[index] != key:
+            return None
+        return self.depths[index], self.scores[index], self.flags[index], self.moves[index]
+
+    def store(self, key, depth, score, flag, move):
+        index = key & self.mask
+        # Depth-preferred: keep a deeper entry of the current search unless it is the same position
+        if self.keys[index] != key and self.ages[index] == self.age and self.depths[index] > depth:
+            return
+        if move == 0 and self.keys[index] == key:
+            move = self.moves[index]  # Keep the old best move for ordering
+        self.keys[index] = key
+        self.moves[index] = move
+        self.scores[index] = score
+        self.depths[index] = depth
+        self.flags[index] = flag
+        self.ages[index] = self.age
+
+class SearchStats:
+    # Counters and timings of one AI turn, filled in by the Searcher, the mate
+    # solver and ShogiEngine.search. to_dict() is the JSON lines form.
+    COUNTERS = ("nodes", "qnodes", "move_generations", "moves_generated", "legality_checks",
+                "tt_probes", "tt_hits", "tt_cutoffs", "beta_cutoffs", "first_move_cutoffs",
+                "mate_nodes", "position_copies")
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.depth = 0
+        self.iterations = []  # (depth, nodes, seconds) of every finished iteration
+        self.phases = {}  # Seconds spent per phase: book, mate, search
+        self.allocated_kb = None  # Peak traced allocations, only when tracing is on
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def nodes_per_second(self):
+        seconds = self.phases.get("search", 0.0)
+        return self.nodes / seconds if seconds else 0.0
+
+    def branching_factor(self):
+        # Effective branching factor: node growth from one iteration to the next
+        if len(self.iterations) < 2 or not self.iterations[-2][1]:
+            return None
+        return self.iterations[-1][1] / self.iterations[-2][1]
+
+    def merge(self, data):
+        # Adds the to_dict() of a search run elsewhere, e.g. in a worker process
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + data[name])
+        self.depth = max(self.depth, data["depth"])
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.COUNTERS}
+        data["depth"] = self.depth
+        data["iterations"] = self.iterations
+        data["phases"] = self.phases
+        data["nodes_per_second"] = round(self.nodes_per_second())
+        data["branching_factor"] = self.branching_factor()
+        data["tt_hit_rate"] = self.tt_hits / self.tt_probes if self.tt_probes else None
+        data["allocated_kb"] = self.allocated_kb
+        return data
+
+    def dump(self, path, **extra):
+        # Appends one JSON line; extra fields (game, ply...) come first
+        with open(path, "a", encoding="utf-8") as stats_file:
+            stats_file.write(json.dumps(dict(extra, **self.to_dict())) + "\n")
+
+class Searcher:
+    # Negamax alpha-beta with iterative deepening under a time budget
+    def __init__(self, max_depth=64, tt_memory_mb=16):
+        self.max_depth = max_depth
+        self.nodes = 0
+        self.deadline = 0
+        self.soft_deadline = 0
+        self.pv = [[] for _ in range(max_depth + 2)]
+        self.tt = TranspositionTable(tt_memory_mb)  # Kept across searches
+        self.orderer = MoveOrderer(max_depth)
+        self.stop_event = None
+        self.game_keys = ()
+        self.path = []
+        self.root_best = None  # (move, score, pv) of the best move of the running iteration
+        self.stats = SearchStats()
+
+    def search(self, position, time_limit, max_depth=None, stop_event=None, root_moves=None, game_keys=(),
+               stats=None, soft_limit=None):
+        # Returns (best move, score, principal variation) of the last finished depth,
+        # or of an unfinished one that already found a better move. The search is
+        # aborted after time_limit; no new depth starts after soft_limit (default
+        # half the time limit). Setting stop_event from another thread ends the search early. root_moves
+        # restricts the search to part of the legal moves (parallel root search).
+        # game_keys holds the hash keys of the positions played so far; reaching
+        # one of them again, or a position earlier on the same line, scores as a draw.
+        # The counters go to stats, or to a fresh SearchStats in self.stats.
+        max_depth = min(max_depth or self.max_depth, self.max_depth)
+        self.stats = stats = stats or SearchStats()
+        start = time.perf_counter()
+        self.deadline = start + time_limit
+        self.soft_deadline = start + (time_limit / 2 if soft_limit is None else min(soft_limit, time_limit))
+        self.nodes = 0
+        self.stop_event = stop_event
+        self.game_keys = game_keys
+        self.path = [0] * (self.max_depth + 1)  # Hash keys of the line being searched
+        self.path[0] = position.hash_key()
+        self.completed = []  # (depth, score, pv) of every finished iteration
+        self.tt.new_search()
+        self.orderer.new_search()
+        
+        if root_moves is None:
+            root_moves = generate_legal_moves(position, stats=stats)
+        if not root_moves:
+            return None, -MATE_SCORE, []
+        scores = score_root_moves(position, root_moves)
+        root_moves = [move for _, move in sorted(zip(scores, root_moves), key=lambda item: -item[0])]
+        
+        best_move, best_score, best_pv = root_moves[0], 0, [root_moves[0]]
+        try:
+            for depth in range(1, max_depth + 1):
+                iteration_start, iteration_nodes = time.perf_counter(), self.nodes
+                self.root_best = None
+                try:
+                    score = self.search_root(position, root_moves, depth)
+                except SearchTimeout:
+                    # The previous best move is searched first, so any other move that
+                    # already beat it at this depth is the better one
+                    if self.root_best is not None and self.root_best[0] != best_move:
+                        best_move, best_score, best_pv = self.root_best
+                    break
+                best_pv = self.pv[0][:]
+                best_move, best_score = best_pv[0], score
+                self.completed.append((depth, score, best_pv))
+                stats.depth = depth
+                stats.iterations.append((depth, self.nodes - iteration_nodes,
+                                         round(time.perf_counter() - iteration_start, 4)))
+                self.tt.store(position.hash_key(), depth, score_to_tt(score, 0), EXACT, best_move)
+                # Search the best move first on the next iteration
+                root_moves.remove(best_move)
+                root_moves.insert(0, best_move)
+                if abs(score) >= MATE_SCORE - self.max_depth:
                     break
+                # A deeper iteration would most likely not finish in the remaining time
+                if time.perf_counter() > self.soft_deadline:
+                    break
+        finally:
+            stats.nodes += self.nodes
+            stats.add_phase("search", time.perf_counter() - start)
+        return best_move, best_score, best_pv
+
+    def ponder_hit(self, time_limit, soft_limit=None):
+        # Called from another thread: the running (ponder) search gets time_limit from now
+        now = time.perf_counter()
+        self.deadline = now + time_limit
+        self.soft_deadline = now + (time_limit / 2 if soft_limit is None else min(soft_limit, time_limit))
+
+    def search_root(self, position, root_moves, depth):
+        alpha = -INFINITE
+        for move in root_moves:
+            undo = position.make_move(move)
+            try:
+                score = -self.negamax(position, depth - 1, -INFINITE, -alpha, 1)
+            finally:
+                position.unmake_move(undo)
+            if score > alpha:
+                alpha = score
+                self.pv[0] = [move] + self.pv[1]
+                self.root_best = (move, score, self.pv[0])
+        return alpha
+
+    def negamax(self, position, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and (time.perf_counter() > self.deadline or
+                                        self.stop_event is not None and self.stop_event.is_set()):
+            raise SearchTimeout()
+        self.pv[ply] = []
+        key = position.hash_key()
+        if key in self.game_keys or key in self.path[:ply]:
+            return 0  # Repetition (sennichite) is scored as a draw
+        if depth <= 0 or ply >= self.max_depth:
+            return self.quiescence(position, alpha, beta, ply)
+        self.path[ply] = key
+        
+        stats = self.stats
+        tt_move = 0
+        stats.tt_probes += 1
+        entry = self.tt.probe(key)
+        if entry is not None:
+            stats.tt_hits += 1
+            entry_depth, entry_score, flag, tt_move = entry
+            if entry_depth >= depth:
+                score = score_from_tt(entry_score, ply)
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    stats.tt_cutoffs += 1
+                    if flag == EXACT and tt_move:
+                        self.pv[ply] = [tt_move]
+                    return score
+        
+        moves = generate_legal_moves(position, stats=stats)
+        stats.move_generations += 1
+        stats.moves_generated += len(moves)
+        if not moves:
+            # No legal move loses in shogi, whether in check or not
+            return -MATE_SCORE + ply
+        moves = self.orderer.order(position, moves, ply, tt_move)
+        
+        original_alpha = alpha
+        best = -INFINITE
+        best_move = 0
+        for move in moves:
+            undo = position.make_move(move)
+            try:
+                score = -self.negamax(position, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                position.unmake_move(undo)
+            if score > best:
+                best = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    self.pv[ply] = [move] + self.pv[ply + 1]
+                    if alpha >= beta:
+                        stats.beta_cutoffs += 1
+                        if move == moves[0]:
+                            stats.first_move_cutoffs += 1
+                        self.orderer.record_cutoff(position, move, ply, depth)
+                        break
+        
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if flag == UPPER:
+            best_move = 0  # No move proved best when every move failed low
+        self.tt.store(key, depth, score_to_tt(best, ply), flag, best_move)
+        return best
+
+    def quiescence(self, position, alpha, beta, ply):
+        # Captures and promotions only, so leaves are never scored in the middle of
+        # an exchange. Moves that lose material by static exchange are skipped.
+        self.nodes += 1
+        stats = self.stats
+        stats.qnodes += 1
+        if self.nodes & 1023 == 0 and (time.perf_counter() > self.deadline or
+                                        self.stop_event is not None and self.stop_event.is_set()):
+            raise SearchTimeout()
+        if ply >= self.max_depth:
+            return evaluate(position)
+        
+        side = position.side_to_move
+        in_check = position.is_in_check(side)
+        if in_check:
+            # No standing pat in check: every evasion is searched
+            moves = generate_legal_moves(position, stats=stats)
+            stats.move_generations += 1
+            stats.moves_generated += len(moves)
+            if not moves:
+                return -MATE_SCORE + ply
+            best = -INFINITE
+        else:
+            best = evaluate(position)
+            if best >= beta:
+                return best
+            alpha = max(alpha, best)
+            moves = [move for move in position.generate_captures() if position.see(move) >= 0]
+            stats.move_generations += 1
+            stats.moves_generated += len(moves)
+        
+        for move in self.orderer.order(position, moves, ply):
+            undo = position.make_move(move)
+            if not in_check:
+                stats.legality_checks += 1
+                if position.is_in_check(side):
+                    position.unmake_move(undo)
+                    continue
+            try:
+                score = -self.quiescence(position, -beta, -alpha, ply + 1)
+            finally:
+                position.unmake_move(undo)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        stats.beta_cutoffs += 1
+                        break
+        return best
+
+# Search state of a worker process of the ParallelSearcher
+worker_searcher = None
+worker_stop_event = None
+
+def init_search_worker(tt_memory_mb, stop_event):
+    global worker_searcher, worker_stop_event
+    worker_searcher = Searcher(tt_memory_mb=tt_memory_mb)
+    worker_stop_event = stop_event
+
+def search_root_subset(data, root_moves, time_limit, max_depth, game_keys, soft_limit=None):
+    # Runs in a worker process on a position sent in packed form
+    position = Position.unpack(data)
+    worker_searcher.search(position, time_limit, max_depth, worker_stop_event, root_moves, game_keys,
+                           soft_limit=soft_limit)
+    return worker_searcher.completed, worker_searcher.stats.to_dict()
+
+class ParallelSearcher:
+    # Splits the root moves over worker processes. Each worker deepens its share
+    # and the best move is picked at the deepest depth every worker finished.
+    def __init__(self, workers=None, max_depth=64, tt_memory_mb=16):
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = SearchStats()
+        self.max_depth = max_depth
+        self.tt_memory_mb = tt_memory_mb  # Per worker
+        self.nodes = 0
+        self.pool = None
+        self.context = multiprocessing.get_context("spawn")  # Never fork the Tk process
+        self.worker_stop = None
+
+    def start(self):
+        if self.pool is None:
+            self.worker_stop = self.context.Event()
+            self.pool = self.context.Pool(self.workers, initializer=init_search_worker,
+                                          initargs=(self.tt_memory_mb, self.worker_stop))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def search(self, position, time_limit, max_depth=None, stop_event=None, game_keys=(), stats=None,
+               soft_limit=None):
+        started = time.perf_counter()
+        self.nodes = 0
+        self.stats = stats = stats or SearchStats()
+        root_moves = generate_legal_moves(position, stats=stats)
+        if not root_moves:
+            return None, -MATE_SCORE, []
+        if len(root_moves) == 1:
+            return root_moves[0], 0, root_moves[:]
+        
+        self.start()
+        self.worker_stop.clear()
+        # Deal the ordered moves round-robin so every worker gets a mix of good and bad ones
+        scores = score_root_moves(position, root_moves)
+        root_moves = [move for _, move in sorted(zip(scores, root_moves), key=lambda item: -item[0])]
+        chunks = [root_moves[i::self.workers] for i in range(min(self.workers, len(root_moves)))]
+        data = position.pack()
+        # Workers get the time left after the legality pass and dispatch
+        elapsed = time.perf_counter() - started + 0.05
+        remaining = max(0.05, time_limit - elapsed)
+        if soft_limit is not None:
+            soft_limit = max(0.0, soft_limit - elapsed)
+        jobs = [self.pool.apply_async(search_root_subset,
+                                      (data, chunk, remaining, max_depth or self.max_depth, game_keys, soft_limit))
+                for chunk in chunks]
+        
+        for job in jobs:
+            while not job.ready():
+                if stop_event is not None and stop_event.is_set():
+                    self.worker_stop.set()
+                job.wait(0.01)
+        results = [job.get() for job in jobs]
+        for _, worker_stats in results:
+            stats.merge(worker_stats)
+        self.nodes = stats.nodes
+        stats.add_phase("search", time.perf_counter() - started)
+        
+        finished = [completed for completed, _ in results if completed]
+        if not finished:
+            return root_moves[0], 0, [root_moves[0]]
+        depth = min(completed[-1][0] for completed in finished)
+        best_score, best_pv = -INFINITE, None
+        for completed in finished:
+            for done_depth, score, pv in completed:
+                if done_depth == depth and score > best_score:
+                    best_score, best_pv = score, pv
+        return best_pv[0], best_score, best_pv
+
+# Mate solver results
+MATE = "mate"
+NO_MATE = "no mate"
+UNKNOWN = "unknown"
+DFPN_INFINITE = 1 << 40
+MAX_MATE_LINE = 255
+
+class MateSolver:
+    # Depth-first proof-number search (df-pn) for a forced mate by the side to
+    # move, as in tsume problems: the attacker must check with every move and
+    # the defender may answer with any legal move. Proof and disproof numbers are
+    # counted for the attacker and kept in a hash table of at most max_entries;
+    # a full table drops the half of its entries that took the least work.
+    def __init__(self, max_entries=1 << 20):
+        self.max_entries = max_entries
+        self.table = {}  # Hash key -> (proof number, disproof number, work)
+        self.path = set()
+        self.nodes = 0
+        self.max_nodes = 0
+        self.deadline = None
+        self.stop_event = None
+        self.attacker = PLAYER
+
+    def solve(self, position, max_nodes=1000000, time_limit=None, stop_event=None):
+        # Returns (MATE, mating moves), (NO_MATE, []) or (UNKNOWN, []) when the
+        # node budget, the time limit or stop_event ran out first
+        self.table = {}
+        self.path = set()
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        self.deadline = time.perf_counter() + time_limit if time_limit is not None else None
+        self.stop_event = stop_event
+        self.attacker = position.side_to_move
+        position = position.copy()
+        try:
+            pn, dn = self.search(position, DFPN_INFINITE, DFPN_INFINITE)
+            if pn == 0:
+                # Reading out the line may have to redo evicted proofs
+                self.max_nodes = self.nodes + max_nodes
+                self.deadline = None
+                return MATE, self.mate_line(position)
+        except SearchTimeout:
+            return UNKNOWN, []
+        if dn == 0:
+            return NO_MATE, []
+        return UNKNOWN, []
+
+    def children(self, position):
+        # (move, hash key after it) of the attacker's checks or of every defence
+        attacking = position.side_to_move == self.attacker
+        children = []
+        for move in generate_legal_moves(position):
+            undo = position.make_move(move)
+            if not attacking or position.is_in_check(position.side_to_move):
+                children.append((move, position.hash_key()))
+            position.unmake_move(undo)
+        return children
+
+    def lookup(self, key):
+        if key in self.path:
+            return DFPN_INFINITE, 0, 0  # Checking in a circle never mates
+        return self.table.get(key, (1, 1, 0))
+
+    def store(self, key, pn, dn, work):
+        table = self.table
+        if len(table) >= self.max_entries and key not in table:
+            works = sorted(entry[2] for entry in table.values())
+            cutoff = works[len(works) // 2]
+            self.table = table = {old: entry for old, entry in table.items() if entry[2] > cutoff}
+        table[key] = (pn, dn, work)
+
+    def search(self, position, pn_limit, dn_limit):
+        # Expands the position until its proof or disproof number reaches its limit
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise SearchTimeout()
+        if self.nodes & 255 == 0 and (self.deadline is not None and time.perf_counter() > self.deadline or
+                                       self.stop_event is not None and self.stop_event.is_set()):
+            raise SearchTimeout()
+        key = position.hash_key()
+        attacking = position.side_to_move == self.attacker
+        children = self.children(position)
+        if not children:
+            # No check left fails, no defence left is mate
+            pn, dn = (DFPN_INFINITE, 0) if attacking else (0, DFPN_INFINITE)
+            self.store(key, pn, dn, 1)
+            return pn, dn
+        
+        start = self.nodes
+        self.path.add(key)
+        try:
+            while True:
+                # At an attacker node the best child has the smallest proof number,
+                # at a defender node the smallest disproof number
+                best = second = DFPN_INFINITE
+                best_move = 0
+                best_pn = best_dn = 0
+                total = 0
+                for move, child_key in children:
+                    child_pn, child_dn = self.lookup(child_key)[:2]
+                    ours, theirs = (child_pn, child_dn) if attacking else (child_dn, child_pn)
+                    total = min(DFPN_INFINITE, total + theirs)
+                    if ours < best:
+                        second = best
+                        best, best_move = ours, move
+                        best_pn, best_dn = child_pn, child_dn
+                    elif ours < second:
+                        second = ours
+                pn, dn = (best, total) if attacking else (total, best)
+                if pn >= pn_limit or dn >= dn_limit:
+                    break
+                if attacking:
+                    child_pn_limit = min(pn_limit, second + 1)
+                    child_dn_limit = dn_limit - dn + best_dn
                 else:
+                    child_pn_limit = pn_limit - pn + best_pn
+                    child_dn_limit = min(dn_limit, second + 1)
+                undo = position.make_move(best_move)
+                try:
+                    self.search(position, child_pn_limit, child_dn_limit)
+                finally:
+                    position.unmake_move(undo)
+        finally:
+            self.path.discard(key)
+        self.store(key, pn, dn, self.nodes - start + 1)
+        return pn, dn
+
+    def mate_line(self, position):
+        # Follows the proof: the attacker takes the proven check that needed the
+        # least work, the defender the defence that needed the most
+        line = []
+        seen = set()
+        while len(line) < MAX_MATE_LINE:
+            key = position.hash_key()
+            children = self.children(position)
+            if not children or key in seen:
+                break
+            seen.add(key)
+            attacking = position.side_to_move == self.attacker
+            proven = [(self.lookup(child_key)[2], move) for move, child_key in children
+                      if self.lookup(child_key)[0] == 0]
+            if attacking and not proven or not attacking and len(proven) < len(children):
+                # Part of the proof was dropped from the table
+                self.search(position, DFPN_INFINITE, DFPN_INFINITE)
+                proven = [(self.lookup(child_key)[2], move) for move, child_key in children
+                          if self.lookup(child_key)[0] == 0]
+                if not proven:
                     break
-                ny += dy
+            work, move = min(proven) if attacking else max(proven)
+            position.make_move(move)
+            line.append(move)
+        return line
+
+def solve_tsume_problem(sfen, max_nodes, time_limit):
+    # One problem of the batch solver, run in a worker process
+    solver = MateSolver()
+    started = time.perf_counter()
+    result, moves = solver.solve(Position.from_sfen(sfen), max_nodes, time_limit)
+    return result, moves, solver.nodes, time.perf_counter() - started
+
+def read_tsume_problems(path):
+    # One SFEN per line, the side to move mates; "#" starts a comment
+    with open(path, encoding="utf-8") as problems:
+        return [line.split("#", 1)[0].strip() for line in problems if line.split("#", 1)[0].strip()]
+
+def run_tsume(paths, max_nodes, time_limit, workers, out=sys.stdout):
+    # Solves every problem of the files in parallel processes and prints one line each
+    problems = []
+    for path in paths:
+        problems.extend((path, index, sfen) for index, sfen in enumerate(read_tsume_problems(path), 1))
+    context = multiprocessing.get_context("spawn")
+    args = [(sfen, max_nodes, time_limit) for _, _, sfen in problems]
+    counts = {MATE: 0, NO_MATE: 0, UNKNOWN: 0}
+    total_nodes = 0
+    started = time.perf_counter()
+    with context.Pool(workers) as pool:
+        for (path, index, sfen), (result, moves, nodes, seconds) in zip(problems, pool.starmap(solve_tsume_problem, args, chunksize=1)):
+            counts[result] += 1
+            total_nodes += nodes
+            text = " ".join([result] + [move_to_usi(move) for move in moves])
+            print(f"{path}:{index}: {text} ({nodes} nodes, {seconds:.2f}s)", file=out)
+    elapsed = time.perf_counter() - started
+    print(f"Solved {counts[MATE]} mates, {counts[NO_MATE]} without mate, {counts[UNKNOWN]} unknown "
+          f"in {elapsed:.2f}s ({total_nodes / elapsed:.0f} nodes/s)", file=out)
+    return counts
+
+DRAW = 2  # Game result next to PLAYER and AI wins
+RESULT_NAMES = {PLAYER: "Player wins", AI: "AI wins", DRAW: "Draw"}
+SENNICHITE_COUNT = 4  # The same position this often ends the game
+# Mate search before every AI search: share of the time, node budget and table size
+MATE_SEARCH_SHARE = 0.1
+MATE_SEARCH_NODES = 20000
+MATE_SEARCH_ENTRIES = 1 << 16
+PONDER_TIME = 3600  # Pondering runs until it is stopped or hit
+# Time management: seconds of a turn kept back to show the move, and the
+# number of legal moves of a position of average complexity
+TIME_RESERVE = 0.5
+TYPICAL_MOVE_COUNT = 40
+
+def allocate_time(remaining, fraction, move_count, in_check):
+    # Splits the time left on a turn into (soft, hard) limits for one search: a
+    # share of it, scaled up for positions with many moves or the king in check
+    # and down for nearly forced ones. The hard limit leaves TIME_RESERVE over.
+    usable = max(0.0, remaining - TIME_RESERVE)
+    if move_count <= 1:
+        return 0.0, 0.0
+    soft = usable * fraction * min(2.0, max(0.5, move_count / TYPICAL_MOVE_COUNT))
+    if in_check:
+        soft *= 1.5
+    if move_count <= 3:
+        soft *= 0.5
+    soft = min(soft, usable / 2)
+    return soft, min(usable, soft * 3)
+
+# Reasons a game ended
+KING_CAPTURED = "king captured"
+CHECKMATE = "checkmate"
+STALEMATE = "no legal moves"
+SENNICHITE = "repetition"
+PERPETUAL_CHECK = "perpetual check"
+
+def initial_position():
+    return Position.from_board(initial_board())
+
+class ShogiEngine:
+    # Rules, move history and AI of one game without any Tk dependency.
+    # The GUI and the command line tools both drive the game through this.
+    def __init__(self, position=None, searcher=None, book=None):
+        self.position = position or initial_position()
+        self.searcher = searcher or Searcher()
+        self.book = book  # OpeningBook or None
+        self.mate_solver = MateSolver(MATE_SEARCH_ENTRIES)
+        self.stats = SearchStats()  # Of the last search or ponder
+        self.trace_allocations = False  # Measure peak allocations per search (slow)
+        self.history = []  # Undo records of the moves played
+        self.legal_cache_key = None
+        self.legal_cache = set()
+        self.status_cache_key = None
+        self.status_cache = (None, None)
+        self.start_repetitions()
+
+    def reset(self, position=None):
+        self.position = position or initial_position()
+        self.history = []
+        self.start_repetitions()
+
+    def start_repetitions(self):
+        # Hash keys of every position reached, with whether the side to move was
+        # in check there, and how often each key occurred
+        self.keys = []
+        self.checks = []
+        self.key_counts = {}
+        self.record_position()
+
+    def record_position(self):
+        key = self.position.hash_key()
+        side = self.position.side_to_move
+        self.keys.append(key)
+        self.checks.append((side, self.position.is_in_check(side)))
+        self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+    def forget_position(self):
+        key = self.keys.pop()
+        self.checks.pop()
+        self.key_counts[key] -= 1
+
+    def set_side_to_move(self, side):
+        # Used when a turn is skipped, e.g. by the turn timer
+        if side != self.position.side_to_move:
+            self.position.side_to_move = side
+            self.record_position()
+
+    def legal_moves(self):
+        return generate_legal_moves(self.position)
+
+    def legal_move_set(self):
+        # Legal moves of the current position, generated once per position
+        key = self.position.hash_key()
+        if key != self.legal_cache_key:
+            self.legal_cache = set(generate_legal_moves(self.position))
+            self.legal_cache_key = key
+        return self.legal_cache
+
+    def play(self, move):
+        self.history.append(self.position.make_move(move))
+        self.record_position()
+
+    def undo(self):
+        self.forget_position()
+        self.position.unmake_move(self.history.pop())
+
+    def promote_last_move(self):
+        # The GUI asks about promotion after the piece has moved
+        move = self.history[-1][0]
+        self.undo()
+        self.play(move | PROMOTE_FLAG)
+
+    def result(self):
+        # Winner (PLAYER, AI or DRAW) or None while the game goes on
+        return self.status()[0]
+
+    def status(self):
+        # (result, reason) of the current position, cached per position and
+        # repetition count. A side whose king is gone or that has no legal move
+        # loses. The fourth repetition is a draw, unless one side gave check with
+        # every move since the position first appeared; that side loses.
+        key = self.position.hash_key()
+        count = self.key_counts.get(key, 0)
+        if (key, count) == self.status_cache_key:
+            return self.status_cache
+        status = (None, None)
+        for side in (PLAYER, AI):
+            if self.position.king_square(side) is None:
+                status = (side ^ 1, KING_CAPTURED)
+                break
+        else:
+            side = self.position.side_to_move
+            if not self.legal_move_set():
+                status = (side ^ 1, CHECKMATE if self.position.is_in_check(side) else STALEMATE)
+            elif count >= SENNICHITE_COUNT:
+                status = (DRAW, SENNICHITE)
+                first = self.keys.index(key)
+                for checker in (PLAYER, AI):
+                    # Positions reached by a move of checker have the other side to move
+                    replies = [in_check for mover, in_check in self.checks[first + 1:] if mover != checker]
+                    if replies and all(replies):
+                        status = (checker ^ 1, PERPETUAL_CHECK)
+        self.status_cache_key = (key, count)
+        self.status_cache = status
+        return status
+
+    def time_budget(self, remaining, fraction):
+        # (soft, hard) search limits for the side to move with remaining seconds on its turn
+        position = self.position
+        return allocate_time(remaining, fraction, len(self.legal_move_set()),
+                             position.is_in_check(position.side_to_move))
+
+    def search(self, time_limit, max_depth=None, stop_event=None, soft_limit=None):
+        # Searches the game position from the thread that plays the moves
+        return self.search_position(self.position.copy(), frozenset(self.keys), time_limit, max_depth,
+                                    stop_event, soft_limit)
+
+    def search_position(self, position, game_keys, time_limit, max_depth=None, stop_event=None, soft_limit=None):
+        # Searches a position the caller copied from the game, with the keys of the
+        # positions played so far; it never touches self.position, so it can run in
+        # another thread. A book move, or the only legal move, is played at once.
+        # Counters and phase times end up in self.stats.
+        self.stats = stats = SearchStats()
+        stats.position_copies = 1  # The caller's copy of the game position
+        moves = generate_legal_moves(position, stats=stats)
+        if len(moves) == 1:
+            return moves[0], 0, moves[:]
+        if self.trace_allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        try:
+            if self.book is not None:
+                started = time.perf_counter()
+                move = self.book.choose(position)
+                stats.add_phase("book", time.perf_counter() - started)
+                if move is not None:
+                    return move, 0, [move]
+            # A short mate search first: alpha-beta finds long mates by drops late
+            started = time.perf_counter()
+            result, line = self.mate_solver.solve(position, MATE_SEARCH_NODES,
+                                                  time_limit * MATE_SEARCH_SHARE, stop_event)
+            stats.mate_nodes = self.mate_solver.nodes
+            stats.position_copies += 1
+            stats.add_phase("mate", time.perf_counter() - started)
+            if result == MATE:
+                return line[0], MATE_SCORE - len(line), line
+            elapsed = time.perf_counter() - started
+            time_limit = max(0.0, time_limit - elapsed)
+            if soft_limit is not None:
+                soft_limit = max(0.0, soft_limit - elapsed)
+            return self.searcher.search(position, time_limit, max_depth, stop_event,
+                                        game_keys=game_keys, stats=stats, soft_limit=soft_limit)
+        finally:
+            if self.trace_allocations:
+                stats.allocated_kb = round(tracemalloc.get_traced_memory()[1] / 1024)
+
+    def ponder(self, position, game_keys, stop_event, time_limit=PONDER_TIME):
+        # Searches a copy of the position after the opponent's expected move until
+        # stopped, or until ponder_hit gives it a real time limit once that move is played
+        self.stats = SearchStats()
+        self.stats.position_copies = 1  # The caller's copy of the game position
+        return self.searcher.search(position, time_limit, None, stop_event, game_keys=game_keys, stats=self.stats)
+
+    def ponder_hit(self, time_limit, soft_limit=None):
+        self.searcher.ponder_hit(time_limit, soft_limit)
+
+def play_selfplay_game(game_index, time_limit, max_depth, max_plies, random_plies, seed, stats_path=None):
+    # One AI-vs-AI game, run in a worker process of the self-play runner. With
+    # stats_path the SearchStats of every searched move are appended there.
+    rng = random.Random(seed + game_index)
+    engine = ShogiEngine(searcher=Searcher(tt_memory_mb=4))
+    started = time.perf_counter()
+    nodes = 0
+    result = None
+    plies = 0
+    while plies < max_plies:
+        result = engine.result()
+        if result is not None:
+            break
+        if plies < random_plies:
+            # Random opening moves so the games differ
+            move = rng.choice(engine.legal_moves())
         else:
-            # Promoted Lancer moves like Gold
-            if self.is_player:
-                directions = [
-                    (-1, -1), (0, -1), (1, -1),
-                    (-1, 0), (1, 0),
-                    (0, 1)
-                ]
+            move, score, pv = engine.search(time_limit, max_depth)
+            nodes += engine.stats.nodes + engine.stats.mate_nodes
+            if stats_path:
+                engine.stats.dump(stats_path, game=game_index, ply=plies)
+        engine.play(move)
+        plies += 1
+    if result is None:
+        result = engine.result()
+    if result is None:
+        result = DRAW
+    moves = [undo[0] for undo in engine.history]
+    return result, plies, nodes, time.perf_counter() - started, moves
+
+def run_selfplay(games, workers, time_limit, max_depth, max_plies, random_plies, seed, stats_path=None,
+                 out=sys.stdout):
+    # Plays games in parallel processes and reports throughput and results
+    context = multiprocessing.get_context("spawn")
+    results = {PLAYER: 0, AI: 0, DRAW: 0}
+    total_plies = 0
+    total_nodes = 0
+    started = time.perf_counter()
+    args = [(index, time_limit, max_depth, max_plies, random_plies, seed, stats_path) for index in range(games)]
+    with context.Pool(workers) as pool:
+        for result, plies, nodes, seconds, moves in pool.starmap(play_selfplay_game, args, chunksize=1):
+            results[result] += 1
+            total_plies += plies
+            total_nodes += nodes
+    elapsed = time.perf_counter() - started
+    print(f"Games: {games} in {elapsed:.2f}s with {workers} workers", file=out)
+    print(f"Games/second: {games / elapsed:.2f}", file=out)
+    print(f"Moves/second: {total_plies / elapsed:.1f} ({total_plies} moves, {total_plies / max(games, 1):.1f} per game)", file=out)
+    print(f"Nodes/second: {total_nodes / elapsed:.0f}", file=out)
+    for result in (PLAYER, AI, DRAW):
+        print(f"{RESULT_NAMES[result]}: {results[result]} ({100 * results[result] / max(games, 1):.1f}%)", file=out)
+    return results
+
+# Opening book file: a magic header, then (position hash key, move, weight)
+# records sorted by key and move, looked up by binary search in a memory map
+BOOK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shogi_book.bin")
+BOOK_MAGIC = b"SHOGIBK1"
+BOOK_RECORD = struct.Struct("<QHH")
+
+class OpeningBook:
+    # Read-only view of a book file. The pages are shared by every process
+    # that opens the same book, and nothing is read before a lookup.
+    def __init__(self, path=BOOK_FILE):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # An empty file cannot be mapped
+            self.file.close()
+            raise ValueError(f"{path} is not an opening book")
+        if self.data[:len(BOOK_MAGIC)] != BOOK_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an opening book")
+        self.count = (len(self.data) - len(BOOK_MAGIC)) // BOOK_RECORD.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def record(self, index):
+        return BOOK_RECORD.unpack_from(self.data, len(BOOK_MAGIC) + index * BOOK_RECORD.size)
+
+    def lookup(self, key):
+        # (move, weight) pairs stored for a position hash key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < key:
+                low = middle + 1
             else:
-                directions = [
-                    (-1, 1), (0, 1), (1, 1),
-                    (-1, 0), (1, 0),
-                    (0, -1)
-                ]
-            
-            for dx, dy in directions:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < 9 and 0 <= ny < 9:
-                    if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                        moves.append((nx, ny))
-        
+                high = middle
+        moves = []
+        while low < self.count:
+            record_key, move, weight = self.record(low)
+            if record_key != key:
+                break
+            moves.append((move, weight))
+            low += 1
         return moves
 
-class Pion(ShogiPiece):
-    def __init__(self, is_player=True):
-        super().__init__("Pion", "歩", "fu", is_player)
+    def choose(self, position, rng=random):
+        # Weighted random legal book move for the side to move, or None
+        legal = set(generate_legal_moves(position))
+        entries = [(move, weight) for move, weight in self.lookup(position.hash_key())
+                   if move in legal and weight > 0]
+        if not entries:
+            return None
+        pick = rng.randrange(sum(weight for _, weight in entries))
+        for move, weight in entries:
+            pick -= weight
+            if pick < 0:
+                return move
 
-    def get_moves(self, board, x, y):
-        moves = []
-        if not self.promoted:
-            if self.is_player:
-                dy = -1  # Forward
-            else:
-                dy = 1  # Forward
-            
-            nx, ny = x, y + dy
-            if 0 <= nx < 9 and 0 <= ny < 9:
-                if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                    moves.append((nx, ny))
+def load_book(path=BOOK_FILE):
+    if os.path.exists(path):
+        return OpeningBook(path)
+    return None
+
+def write_book(entries, path=BOOK_FILE):
+    # entries maps (hash key, move) to a weight
+    with open(path, "wb") as book_file:
+        book_file.write(BOOK_MAGIC)
+        for (key, move), weight in sorted(entries.items()):
+            book_file.write(BOOK_RECORD.pack(key, move, min(weight, 0xFFFF)))
+
+def add_book_game(entries, moves, plies, winner=None, skip=0):
+    # Counts the first plies moves of a game from the start position. With a
+    # known result the winner's moves count twice, a draw's once and the
+    # loser's not at all; a record without a result counts every move once.
+    # The first skip moves (random self-play openings) are played but not counted.
+    position = initial_position()
+    for ply, move in enumerate(moves[:plies]):
+        side = position.side_to_move
+        if ply < skip:
+            position.make_move(move)
+            continue
+        if winner is None or winner == DRAW:
+            weight = 1
+        else:
+            weight = 2 if winner == side else 0
+        if weight:
+            entry = (position.hash_key(), move)
+            entries[entry] = entries.get(entry, 0) + weight
+        position.make_move(move)
+
+def read_game_records(path):
+    # One game per line as USI moves from the start position; "#" starts a comment
+    games = []
+    with open(path, encoding="utf-8") as records:
+        for line_number, line in enumerate(records, 1):
+            line = line.split("#", 1)[0].split()
+            if not line:
+                continue
+            position = initial_position()
+            moves = []
+            for text in line:
+                move = move_from_usi(text)
+                if move not in generate_legal_moves(position):
+                    raise ValueError(f"{path}:{line_number}: illegal move {text}")
+                position.make_move(move)
+                moves.append(move)
+            games.append(moves)
+    return games
+
+def build_book(path, record_files=(), games=0, workers=1, time_limit=0.1, max_depth=None,
+               max_plies=300, plies=16, random_plies=2, seed=0, min_weight=1, out=sys.stdout):
+    # Builds the book from game records and/or fresh self-play games
+    entries = {}
+    imported = 0
+    for record_file in record_files:
+        for moves in read_game_records(record_file):
+            add_book_game(entries, moves, plies)
+            imported += 1
+    if games:
+        context = multiprocessing.get_context("spawn")
+        args = [(index, time_limit, max_depth, max_plies, random_plies, seed) for index in range(games)]
+        with context.Pool(workers) as pool:
+            for result, _, _, _, moves in pool.starmap(play_selfplay_game, args, chunksize=1):
+                add_book_game(entries, moves, plies, result, random_plies)
+    entries = {entry: weight for entry, weight in entries.items() if weight >= min_weight}
+    write_book(entries, path)
+    positions = len(set(key for key, _ in entries))
+    print(f"Book: {len(entries)} moves in {positions} positions from {imported} records "
+          f"and {games} self-play games, written to {path}", file=out)
+
+# With --record the game window appends its games to two files as they are
+# played: CSA text, several games separated by "/", and a binary form of one
+# uint16 per move (the move with the mover in bit 15) between a start marker and
+# an end marker followed by the result. Both start from the initial position.
+RECORD_TEXT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shogi_games.csa")
+RECORD_BINARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shogi_games.sgr")
+RECORD_START = 0xFFFE  # No move has from square 127
+RECORD_END = 0xFFFF
+UNFINISHED = 3  # Result code of a game that was stopped or cut off
+CSA_PIECES = ["FU", "KY", "KE", "GI", "KA", "HI", "KI", "OU", "TO", "NY", "NK", "NG", "UM", "RY"]
+# The mated side is the side to move; perpetual check names its loser, who may
+# have moved last or not, with the side-specific %+ / %-ILLEGAL_ACTION
+CSA_RESULTS = {KING_CAPTURED: "%TSUMI", CHECKMATE: "%TSUMI", STALEMATE: "%TSUMI",
+               SENNICHITE: "%SENNICHITE"}
+
+def csa_square(sq):
+    return f"{9 - sq % 9}{sq // 9 + 1}"
+
+def move_to_csa(move, moved):
+    # moved is the piece code before the move, as kept in the undo record
+    from_sq = move & 127
+    to_sq = move >> 7 & 127
+    kind = moved & 15
+    if move & PROMOTE_FLAG:
+        kind |= PROMOTED
+    sign = "+" if moved >> 4 == PLAYER else "-"
+    origin = "00" if from_sq >= DROP_BASE else csa_square(from_sq)
+    return f"{sign}{origin}{csa_square(to_sq)}{CSA_PIECES[kind]}"
+
+def move_from_csa(position, text):
+    # (side, move) of a CSA move line such as +7776FU on the given position
+    if len(text) < 7 or text[0] not in "+-" or not text[1:5].isdigit() or text[5:7] not in CSA_PIECES:
+        raise ValueError(f"Bad CSA move {text!r}")
+    side = PLAYER if text[0] == "+" else AI
+    kind = CSA_PIECES.index(text[5:7])
+    to_sq = (int(text[4]) - 1) * 9 + 9 - int(text[3])
+    if text[1:3] == "00":
+        return side, encode_drop(kind, to_sq)
+    from_sq = (int(text[2]) - 1) * 9 + 9 - int(text[1])
+    code = position.squares[from_sq]
+    if code is None:
+        raise ValueError(f"CSA move {text!r} has no piece to move")
+    return side, encode_move(from_sq, to_sq, kind != code & 15)
+
+class GameRecorder:
+    # Appends every move to the text and binary records as soon as it is played
+    def __init__(self, text_path=RECORD_TEXT_FILE, binary_path=RECORD_BINARY_FILE):
+        self.text_file = open(text_path, "a", encoding="utf-8")
+        self.binary_file = open(binary_path, "ab")
+        self.in_game = False
+
+    def close(self):
+        self.text_file.close()
+        self.binary_file.close()
+
+    def start_game(self):
+        self.text_file.write("V2.2\nN+Player\nN-AI\n")
+        self.text_file.write(time.strftime("$START_TIME:%Y/%m/%d %H:%M:%S\n"))
+        self.text_file.write("PI\n+\n")
+        self.binary_file.write(struct.pack("<H", RECORD_START))
+        self.flush()
+        self.in_game = True
+
+    def record(self, move, moved):
+        if not self.in_game:
+            self.start_game()
+        self.text_file.write(move_to_csa(move, moved) + "\n")
+        self.binary_file.write(struct.pack("<H", move | (moved >> 4) << 15))
+        self.flush()
+
+    def finish(self, result=None, reason=None):
+        # result None marks a game that was stopped before it ended
+        if not self.in_game:
+            return
+        if result is None:
+            self.text_file.write("%CHUDAN\n")
         else:
-            # Promoted Pawn (Tokin) moves like Gold
-            if self.is_player:
-                directions = [
-                    (-1, -1), (0, -1), (1, -1),
-                    (-1, 0), (1, 0),
-                    (0, 1)
-                ]
+            if reason == PERPETUAL_CHECK:
+                self.text_file.write(("%-" if result == PLAYER else "%+") + "ILLEGAL_ACTION\n")
             else:
-                directions = [
-                    (-1, 1), (0, 1), (1, 1),
-                    (-1, 0), (1, 0),
-                    (0, -1)
-                ]
-            
-            for dx, dy in directions:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < 9 and 0 <= ny < 9:
-                    if board[ny][nx] is None or board[ny][nx].is_player != self.is_player:
-                        moves.append((nx, ny))
-        
-        return moves
+                self.text_file.write(CSA_RESULTS[reason] + "\n")
+            self.text_file.write(f"'{RESULT_NAMES[result]} ({reason})\n")
+        self.text_file.write("/\n")
+        self.binary_file.write(struct.pack("<HH", RECORD_END, UNFINISHED if result is None else result))
+        self.flush()
+        self.in_game = False
+
+    def flush(self):
+        self.text_file.flush()
+        self.binary_file.flush()
+
+def iter_binary_games(path, chunk_size=1 << 16):
+    # Streams (moves, result) from a binary record, moves as (side, move) pairs.
+    # A game without an end marker counts as unfinished.
+    moves = None
+    expect_result = False
+    with open(path, "rb") as records:
+        while True:
+            chunk = records.read(chunk_size)
+            if not chunk:
+                break
+            for (value,) in struct.iter_unpack("<H", chunk[:len(chunk) & ~1]):
+                if expect_result:
+                    expect_result = False
+                    yield moves or [], value
+                    moves = None
+                elif value == RECORD_START:
+                    if moves is not None:
+                        yield moves, UNFINISHED
+                    moves = []
+                elif value == RECORD_END:
+                    expect_result = True
+                elif moves is not None:
+                    moves.append((value >> 15, value & 0x7FFF))
+    if moves is not None and not expect_result:
+        yield moves, UNFINISHED
+
+def iter_csa_games(path):
+    # Streams (moves, result) from a CSA text record with games separated by "/"
+    position = initial_position()
+    moves = []
+    result = UNFINISHED
+    with open(path, encoding="utf-8") as records:
+        for line in records:
+            line = line.strip()
+            if line == "/":
+                yield moves, result
+                position, moves, result = initial_position(), [], UNFINISHED
+            elif len(line) > 1 and line[0] in "+-":
+                side, move = move_from_csa(position, line)
+                position.side_to_move = side
+                position.make_move(move)
+                moves.append((side, move))
+            elif line == "%SENNICHITE":
+                result = DRAW
+            elif line == "%CHUDAN":
+                result = UNFINISHED
+            elif line in ("%+ILLEGAL_ACTION", "%-ILLEGAL_ACTION"):
+                result = AI if line[1] == "+" else PLAYER  # The named side broke a rule
+            elif line.startswith("%"):
+                result = position.side_to_move ^ 1  # Mate or resignation of the side to move
+    if moves:
+        yield moves, result
+
+def iter_recorded_games(path):
+    if path.endswith(".csa"):
+        return iter_csa_games(path)
+    return iter_binary_games(path)
+
+def mate_sign(score):
+    # 1 for a forced mate, -1 for being mated, 0 for any other score
+    if score > MATE_SCORE - 1000:
+        return 1
+    if score < -MATE_SCORE + 1000:
+        return -1
+    return 0
+
+def analyze_game(moves, result, time_limit, max_depth, blunder):
+    # Runs in a worker process: searches every position of the game and
+    # measures how much each played move lost against the best score. Mate
+    # scores count plies, not material, so they stay out of the average: a
+    # move that gives away a mate or walks into one is listed on its own.
+    position = initial_position()
+    scores = []
+    for side, move in moves:
+        position.side_to_move = side
+        _, score, _ = worker_searcher.search(position, time_limit, max_depth)
+        scores.append((side, score))
+        position.make_move(move)
+    _, score, _ = worker_searcher.search(position, time_limit, max_depth)
+    scores.append((position.side_to_move, score))
+    losses = []
+    blunders = []
+    mate_errors = []
+    for ply, ((side, score), (next_side, next_score)) in enumerate(zip(scores, scores[1:]), 1):
+        after = -next_score if next_side != side else next_score
+        if mate_sign(score) or mate_sign(after):
+            if mate_sign(after) < mate_sign(score):
+                mate_errors.append(ply)
+            continue
+        loss = max(0, score - after)
+        losses.append(loss)
+        if loss >= blunder:
+            blunders.append(ply)
+    return len(moves), result, sum(losses) / max(len(losses), 1), blunders, mate_errors
+
+def report_analysis(job, path, index, out):
+    plies, result, average_loss, blunders, mate_errors = job.get()
+    name = RESULT_NAMES.get(result, "Unfinished")
+    listed = " ".join(str(ply) for ply in blunders) or "none"
+    mates = " ".join(str(ply) for ply in mate_errors) or "none"
+    print(f"{path}:{index}: {plies} moves, {name}, average loss {average_loss:.1f}, blunders at {listed}, "
+          f"mates missed or allowed at {mates}", file=out)
+    return plies
+
+def run_analysis(paths, workers, time_limit, max_depth, blunder, tt_memory_mb=4, out=sys.stdout):
+    # Streams every game of the records through a process pool. At most a few
+    # games per worker are in flight, so archives are never held in memory.
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    games = 0
+    total_moves = 0
+    pending = deque()
+    with context.Pool(workers, initializer=init_search_worker, initargs=(tt_memory_mb, None)) as pool:
+        for path in paths:
+            for index, (moves, result) in enumerate(iter_recorded_games(path), 1):
+                pending.append((pool.apply_async(analyze_game, (moves, result, time_limit, max_depth, blunder)),
+                                path, index))
+                if len(pending) >= workers * 4:
+                    total_moves += report_analysis(*pending.popleft(), out)
+                    games += 1
+        while pending:
+            total_moves += report_analysis(*pending.popleft(), out)
+            games += 1
+    elapsed = time.perf_counter() - started
+    print(f"Analyzed {games} games, {total_moves} moves in {elapsed:.2f}s "
+          f"({total_moves / elapsed:.1f} moves/s with {workers} workers)", file=out)
+    return games
+
+# Known leaf counts by SFEN, depth 1 first
+PERFT_REFERENCE = {
+    START_SFEN: [30, 900, 25470, 719731, 19861490],
+}
+
+def perft(position, depth):
+    # Number of legal move sequences of the given length
+    moves = generate_legal_moves(position)
+    if depth <= 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        undo = position.make_move(move)
+        nodes += perft(position, depth - 1)
+        position.unmake_move(undo)
+    return nodes
+
+def perft_divide(position, depth):
+    # Leaf count below every legal root move, for hunting down move generation bugs
+    counts = {}
+    for move in generate_legal_moves(position):
+        undo = position.make_move(move)
+        counts[move] = perft(position, depth - 1) if depth > 1 else 1
+        position.unmake_move(undo)
+    return counts
+
+def run_perft(position, depth, reference=None, divide=False, out=sys.stdout):
+    # Counts every depth up to depth, reports nodes/second and checks the reference counts.
+    # Returns False when a count does not match.
+    ok = True
+    for current in range(1, depth + 1):
+        started = time.perf_counter()
+        nodes = perft(position, current)
+        elapsed = time.perf_counter() - started
+        line = f"Depth {current}: {nodes} nodes in {elapsed:.3f}s ({nodes / max(elapsed, 1e-9):.0f} nodes/s)"
+        if reference is not None and current <= len(reference):
+            if nodes == reference[current - 1]:
+                line += " OK"
+            else:
+                line += f" MISMATCH, expected {reference[current - 1]}"
+                ok = False
+        print(line, file=out)
+    if divide:
+        for move, count in sorted(perft_divide(position, depth).items()):
+            print(f"{move_to_text(move)}: {count}", file=out)
+    return ok
+
+def move_to_text(move):
+    # Board coordinates as used by the GUI: x,y -> x,y, "*" for drops and "+" for promotion
+    from_sq = move & 127
+    to_sq = move >> 7 & 127
+    target = f"{to_sq % 9},{to_sq // 9}"
+    if from_sq >= DROP_BASE:
+        return f"{PIECE_NAMES[from_sq - DROP_BASE]}*{target}"
+    text = f"{from_sq % 9},{from_sq // 9}->{target}"
+    if move & PROMOTE_FLAG:
+        text += "+"
+    return text
+
+# USI move notation: file 9..1 from the left (x = 0 is file 9), rank a..i from the top
+USI_RANKS = "abcdefghi"
+
+def usi_square(sq):
+    return f"{9 - sq % 9}{USI_RANKS[sq // 9]}"
+
+def move_to_usi(move):
+    from_sq = move & 127
+    to_sq = move >> 7 & 127
+    if from_sq >= DROP_BASE:
+        return f"{SFEN_LETTERS[from_sq - DROP_BASE]}*{usi_square(to_sq)}"
+    return usi_square(from_sq) + usi_square(to_sq) + ("+" if move & PROMOTE_FLAG else "")
+
+def move_from_usi(text):
+    def square(file_char, rank_char):
+        if file_char not in "123456789" or rank_char not in USI_RANKS:
+            raise ValueError(f"Bad USI move {text!r}")
+        return USI_RANKS.index(rank_char) * 9 + 9 - int(file_char)
+    if len(text) == 4 and text[1] == "*" and text[0] in SFEN_LETTERS[:HAND_KINDS]:
+        return encode_drop(SFEN_LETTERS.index(text[0]), square(text[2], text[3]))
+    if len(text) not in (4, 5) or (len(text) == 5 and text[4] != "+"):
+        raise ValueError(f"Bad USI move {text!r}")
+    return encode_move(square(text[0], text[1]), square(text[2], text[3]), len(text) == 5)
 
 class ShogiGame:
-    def __init__(self, root):
+    def __init__(self, root, record=False, ai_workers=1):
         self.root = root
         self.root.title("Shogi - Japanese Chess Game")
         self.root.geometry("800x650")
@@ -402,15 +2442,75 @@ class ShogiGame:
         self.ai_score = 0
         self.time_limit = 10  # time per second
         self.move_timer = None
+        self.turn_deadline = 0  # perf_counter() time the current turn runs out
+        self.ai_time_fraction = 0.3  # Share of the turn time a typical AI search gets
+        self.ai_workers = ai_workers  # Processes for the AI search, more than one splits the root moves
+        if self.ai_workers > 1:
+            searcher = ParallelSearcher(self.ai_workers)
+        else:
+            searcher = Searcher()
+        # Rules and AI live in the engine, self.board holds the piece objects shown on screen
+        self.engine = ShogiEngine(Position.from_board(self.board), searcher, load_book())
+        
+        # The AI searches in a worker thread and posts its result to this queue
+        self.ai_results = queue.Queue()
+        self.ai_thread = None
+        self.ai_search_id = 0  # Results of older (cancelled) searches are ignored
+        self.ai_stop_event = threading.Event()
+        # While the player thinks the AI searches the reply it expects (pondering)
+        self.ai_ponder = self.ai_workers == 1  # Worker processes keep their own deadlines
+        self.ai_pv = []
+        self.ponder_key = None  # Hash key of the position being pondered
+        self.ai_stats_file = None  # When set, every AI turn's SearchStats are appended as JSON lines
+        self.ai_start_job = None
+        self.ai_poll_job = None
+        
+        # Canvas items are made on the first update and then only reconfigured.
+        # The *_state lists hold what each item shows, so unchanged ones are skipped.
+        self.square_items = None
+        self.square_state = [None] * 81
+        self.highlight_items = []
+        self.highlighted = set()
+        self.capture_items = {}
+        self.capture_state = {}
+        
+        # With record set, moves are appended to the game records as they are played
+        self.recorder = None
+        if record:
+            try:
+                self.recorder = GameRecorder()
+            except OSError:
+                pass
+        self.recorded_plies = 0  # Moves of engine.history already recorded
         
         self.create_gui()
         self.update_board_display()
         self.start_turn_timer()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+    
+    def close(self):
+        # Stops the AI and releases the record files, the book and worker processes
+        if self.move_timer:
+            self.root.after_cancel(self.move_timer)
+        self.cancel_ai_search()
+        if self.ai_thread is not None:
+            self.ai_thread.join()
+        if self.recorder is not None:
+            self.recorder.finish()
+            self.recorder.close()
+            self.recorder = None
+        if self.engine.book is not None:
+            self.engine.book.close()
+            self.engine.book = None
+        if isinstance(self.engine.searcher, ParallelSearcher):
+            self.engine.searcher.close()
+        self.root.destroy()
         
     def start_turn_timer(self):
         if self.move_timer:
             self.root.after_cancel(self.move_timer)
         self.time_remaining = self.time_limit
+        self.turn_deadline = time.perf_counter() + self.time_limit
         self.update_timer()
         self.move_timer = self.root.after(1000, self.decrement_timer)
 
@@ -427,55 +2527,30 @@ class ShogiGame:
             if self.player_turn:
                 self.status_label.config(text="Time's up! Turn changes to AI.")
                 self.player_turn = False
+                self.engine.set_side_to_move(AI)
                 self.update_board_display()
-                self.root.after(500, self.ai_move)
+                self.ai_start_job = self.root.after(500, self.ai_move)
+            elif self.ai_poll_job is not None:
+                # The search is given less time than the turn, but the Tk timer may run
+                # ahead of it: stop it now and play the best move found so far
+                self.ai_stop_event.set()
+                return
             else:
+                self.cancel_ai_search()
                 self.status_label.config(text="Time's up! Turn changes to Player.")
                 self.player_turn = True
+                self.engine.set_side_to_move(PLAYER)
                 self.update_board_display()
             
             # Reset timer for the next turn
             self.start_turn_timer()
     
+    @property
+    def position(self):
+        return self.engine.position
+    
     def initialize_board(self):
-        # Create empty 9x9 board
-        board = [[None for _ in range(9)] for _ in range(9)]
-        
-        # Initial positions for player pieces (rows 6-8)
-        board[8][0] = Lancer(True)
-        board[8][1] = Knight(True)
-        board[8][2] = Silver(True)
-        board[8][3] = Gold(True)
-        board[8][4] = King(True)
-        board[8][5] = Gold(True)
-        board[8][6] = Silver(True)
-        board[8][7] = Knight(True)
-        board[8][8] = Lancer(True)
-  
-        board[7][1] = Bishop(True)
-        board[7][7] = Rook(True)
-        
-        for i in range(9):
-            board[6][i] = Pion(True)
-        
-        # Initial positions for AI pieces (rows 0-2)
-        board[0][0] = Lancer(False)
-        board[0][1] = Knight(False)
-        board[0][2] = Silver(False)
-        board[0][3] = Gold(False)
-        board[0][4] = King(False)
-        board[0][5] = Gold(False)
-        board[0][6] = Silver(False)
-        board[0][7] = Knight(False)
-        board[0][8] = Lancer(False)
-        
-        board[1][1] = Rook(False)
-        board[1][7] = Bishop(False)
-        
-        for i in range(9):
-            board[2][i] = Pion(False)
-            
-        return board
+        return initial_board()
     
     def create_gui(self):
         self.main_frame = Frame(self.root, bg="#F5DEB3")
@@ -554,65 +2629,74 @@ class ShogiGame:
             self.update_board_display()
 
     def get_piece_value(self, piece):
-        values = {"Pion": 1, "Lancer": 3, "Knight": 3, "Silver": 5, "Gold": 6, "Bishop": 8, "Rook": 10, "King": 100}
-        # Add bonus for promoted pieces
-        value = values.get(piece.name, 0)
-        if piece.promoted:
-            value += 2
-        return value
+        # Promoted kinds carry a +2 bonus in the shared table
+        return PIECE_VALUES[piece.get_kind()]
     
-    def update_board_display(self):
-        self.canvas.delete("all")
-        
-        # Use fixed cell size for consistent board display
+    def create_board_items(self):
         cell_size = 50
-        
-        # Draw 9x9 board
+        self.square_items = []
         for y in range(9):
             for x in range(9):
+                x0, y0, x1, y1 = x*cell_size, y*cell_size, (x+1)*cell_size, (y+1)*cell_size
                 # Draw square for each cell
-                self.canvas.create_rectangle(x*cell_size, y*cell_size, (x+1)*cell_size, (y+1)*cell_size, 
-                                           fill="#E8C184", outline="#000000")
+                self.canvas.create_rectangle(x0, y0, x1, y1, fill="#E8C184", outline="#000000")
                 
-                # Draw promotion zone
-                if y < 3:  # Player's promotion zone
-                    self.canvas.create_rectangle(x*cell_size, y*cell_size, (x+1)*cell_size, (y+1)*cell_size, 
-                                               fill="#E8C184", outline="#000000", stipple="gray50")
-                elif y > 5:  # AI's promotion zone
-                    self.canvas.create_rectangle(x*cell_size, y*cell_size, (x+1)*cell_size, (y+1)*cell_size, 
-                                               fill="#E8C184", outline="#000000", stipple="gray50")
+                # Draw promotion zones (player's on top, AI's at the bottom)
+                if y < 3 or y > 5:
+                    self.canvas.create_rectangle(x0, y0, x1, y1, fill="#E8C184", outline="#000000", stipple="gray50")
                 
-                # Draw pieces on each cell
-                if self.board[y][x]:
-                    piece = self.board[y][x]
+                # Circle, kanji and romaji of a piece, hidden while the square is empty
+                oval = self.canvas.create_oval(x0+5, y0+5, x1-5, y1-5, fill="#FFD700", outline="#000000", state="hidden")
+                kanji = self.canvas.create_text(x0+cell_size/2, y0+cell_size/2-7, text="", fill="#000000",
+                                                font=("Arial", 14), state="hidden")
+                romaji = self.canvas.create_text(x0+cell_size/2, y0+cell_size/2+10, text="", fill="#000000",
+                                                 font=("Arial", 8), state="hidden")
+                self.square_items.append((oval, kanji, romaji))
+        
+        # Move highlights go above every piece
+        self.highlight_items = [self.canvas.create_rectangle(sq % 9*cell_size, sq // 9*cell_size,
+                                                             (sq % 9+1)*cell_size, (sq // 9+1)*cell_size,
+                                                             outline="#0000FF", width=2, state="hidden")
+                                for sq in range(81)]
+    
+    def update_board_display(self):
+        if self.square_items is None:
+            self.create_board_items()
+        
+        # Reconfigure only the squares whose piece or selection changed
+        for y in range(9):
+            for x in range(9):
+                piece = self.board[y][x]
+                if piece is None:
+                    state = None
+                else:
                     bg_color = "#FFD700" if piece.is_player else "#FF6347"
-                    text_color = "#000000"
-                    
                     # Highlight selected piece
                     if self.selected_pos and self.selected_pos == (x, y):
                         bg_color = "#00FF00"
-                    
-                    # Create circle for piece
-                    self.canvas.create_oval(x*cell_size+5, y*cell_size+5, (x+1)*cell_size-5, (y+1)*cell_size-5, 
-                                          fill=bg_color, outline="#000000")
-                    
-                    # Add kanji for piece
-                    self.canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2-7, 
-                                          text=piece.get_display_name(), fill=text_color, font=("Arial", 14))
-                    
-                    # Add romaji below the kanji
-                    self.canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2+10, 
-                                          text=piece.get_display_romaji(), fill=text_color, font=("Arial", 8))
+                    state = (piece.get_display_name(), piece.get_display_romaji(), bg_color)
+                sq = y * 9 + x
+                if state == self.square_state[sq]:
+                    continue
+                self.square_state[sq] = state
+                oval, kanji, romaji = self.square_items[sq]
+                if state is None:
+                    for item in (oval, kanji, romaji):
+                        self.canvas.itemconfig(item, state="hidden")
+                else:
+                    self.canvas.itemconfig(oval, fill=state[2], state="normal")
+                    self.canvas.itemconfig(kanji, text=state[0], state="normal")
+                    self.canvas.itemconfig(romaji, text=state[1], state="normal")
         
-        # Highlight possible moves
+        # Highlight possible moves, showing and hiding only the squares that changed
+        targets = set()
         if self.selected_piece and self.selected_pos:
             x, y = self.selected_pos
-            moves = self.selected_piece.get_moves(self.board, x, y)
-            for move_x, move_y in moves:
-                if self.selected_piece.is_valid_move(self.board, x, y, move_x, move_y):
-                    self.canvas.create_rectangle(move_x*cell_size, move_y*cell_size, 
-                                               (move_x+1)*cell_size, (move_y+1)*cell_size, 
-                                               outline="#0000FF", width=2)
+            from_sq = y * 9 + x
+            targets = set((move >> 7 & 127) for move in self.engine.legal_move_set() if move & 127 == from_sq)
+        for sq in targets ^ self.highlighted:
+            self.canvas.itemconfig(self.highlight_items[sq], state="normal" if sq in targets else "hidden")
+        self.highlighted = targets
         
         # Update captured pieces display
         self.update_captures_display()
@@ -624,40 +2708,39 @@ class ShogiGame:
         self.score_label.config(text=f"Player: {self.player_score} | AI: {self.ai_score}")
     
     def update_captures_display(self):
-        self.player_capture_canvas.delete("all")
-        self.ai_capture_canvas.delete("all")
-        
+        self.update_capture_canvas(self.player_capture_canvas, self.player_captures, "#FFD700")
+        self.update_capture_canvas(self.ai_capture_canvas, self.ai_captures, "#FF6347")
+    
+    def update_capture_canvas(self, canvas, captures, fill):
+        # One slot per captured piece, 10 to a column; slots are made when first needed
+        # and hidden when the hand shrinks
         cell_size = 40
-        
-        # Player's captured pieces
-        for i, piece in enumerate(self.player_captures):
-            y = i % 10
-            x = i // 10
-            
-            self.player_capture_canvas.create_oval(x*cell_size+5, y*cell_size+5, 
-                                                (x+1)*cell_size-5, (y+1)*cell_size-5, 
-                                                fill="#FFD700", outline="#000000")
-            
-            self.player_capture_canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2-5, 
-                                                text=piece.kanji, fill="#000000", font=("Arial", 12))
-            
-            self.player_capture_canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2+8, 
-                                                text=piece.romaji, fill="#000000", font=("Arial", 6))
-        
-        # AI's captured pieces
-        for i, piece in enumerate(self.ai_captures):
-            y = i % 10
-            x = i // 10
-            
-            self.ai_capture_canvas.create_oval(x*cell_size+5, y*cell_size+5, 
-                                             (x+1)*cell_size-5, (y+1)*cell_size-5, 
-                                             fill="#FF6347", outline="#000000")
-            
-            self.ai_capture_canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2-5, 
-                                             text=piece.kanji, fill="#000000", font=("Arial", 12))
-            
-            self.ai_capture_canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2+8, 
-                                             text=piece.romaji, fill="#000000", font=("Arial", 6))
+        items = self.capture_items.setdefault(canvas, [])
+        shown = self.capture_state.setdefault(canvas, [])
+        for i in range(max(len(captures), len(items))):
+            if i == len(items):
+                y = i % 10
+                x = i // 10
+                items.append((canvas.create_oval(x*cell_size+5, y*cell_size+5, 
+                                                 (x+1)*cell_size-5, (y+1)*cell_size-5, 
+                                                 fill=fill, outline="#000000"),
+                              canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2-5, 
+                                                 text="", fill="#000000", font=("Arial", 12)),
+                              canvas.create_text(x*cell_size+cell_size/2, y*cell_size+cell_size/2+8, 
+                                                 text="", fill="#000000", font=("Arial", 6))))
+                shown.append(None)
+            state = (captures[i].kanji, captures[i].romaji) if i < len(captures) else None
+            if state == shown[i]:
+                continue
+            shown[i] = state
+            oval, kanji, romaji = items[i]
+            if state is None:
+                for item in (oval, kanji, romaji):
+                    canvas.itemconfig(item, state="hidden")
+            else:
+                canvas.itemconfig(oval, state="normal")
+                canvas.itemconfig(kanji, text=state[0], state="normal")
+                canvas.itemconfig(romaji, text=state[1], state="normal")
     
     def handle_click(self, event):
         if not self.player_turn:
@@ -690,7 +2773,7 @@ class ShogiGame:
                 if self.selected_pos is not None:
                     # Moving from board
                     from_x, from_y = self.selected_pos
-                    if self.selected_piece.is_valid_move(self.board, from_x, from_y, x, y):
+                    if self.is_legal_move(from_x, from_y, x, y):
                         # Store the piece before moving (it might get reset in move_piece)
                         piece_to_check = self.selected_piece
                         
@@ -699,7 +2782,7 @@ class ShogiGame:
                         
                         # Check if the piece needs to be promoted
                         if piece_to_check.must_promote(y):
-                            piece_to_check.promote()
+                            self.promote_piece(piece_to_check, x, y)
                             self.status_label.config(text=f"{piece_to_check.name} automatically promoted!")
                             # End player's turn after the move
                             self.end_player_turn()
@@ -707,6 +2790,7 @@ class ShogiGame:
                         elif piece_to_check.can_promote(from_y, y):
                             # Store reference to the piece
                             self.piece_to_promote = piece_to_check
+                            self.promote_pos = (x, y)
                             self.ask_promotion()
                         else:
                             # End player's turn
@@ -745,7 +2829,26 @@ class ShogiGame:
             self.status_label.config(text=f"Captured {self.selected_piece.name} selected. Choose destination for drop.")
             self.update_board_display()
     
+    def is_legal_move(self, from_x, from_y, to_x, to_y):
+        # A forced promotion only exists as the promoting move; promote_piece adds it later
+        move = encode_move(from_y * 9 + from_x, to_y * 9 + to_x)
+        legal = self.engine.legal_move_set()
+        return move in legal or move | PROMOTE_FLAG in legal
+    
+    def promote_piece(self, piece, x, y):
+        piece.promote()
+        # The board may have been reset by a game over in the meantime
+        if self.board[y][x] is piece:
+            self.engine.promote_last_move()
+    
     def move_piece(self, from_x, from_y, to_x, to_y):
+        # Mirror the move on the bitboard position before the board changes
+        self.engine.set_side_to_move(PLAYER if self.player_turn else AI)
+        if from_x is not None and from_y is not None:
+            self.engine.play(encode_move(from_y * 9 + from_x, to_y * 9 + to_x))
+        else:
+            self.engine.play(encode_drop(self.selected_piece.kind, to_y * 9 + to_x))
+        
         # Handle captured pieces
         if self.board[to_y][to_x] is not None:
             captured = self.board[to_y][to_x]
@@ -775,246 +2878,251 @@ class ShogiGame:
         # Reset selection
         self.selected_piece = None
         self.selected_pos = None
-        
-        # Check for game over
-        self.check_game_over()
     
     def drop_piece(self, piece, x, y):
         if self.board[y][x] is not None:
             return False
         
-        # Check if it's a valid drop
-        if piece.name == "Pion":
-            # Check for two pawns in the same column
-            for row in range(9):
-                if self.board[row][x] is not None and self.board[row][x].name == "Pion" and self.board[row][x].is_player == piece.is_player:
-                    self.status_label.config(text="Cannot drop Pawn in a column with another Pawn.")
-                    return False
-            
-            # Check for dropping on the last rank
-            if (piece.is_player and y == 0) or (not piece.is_player and y == 8):
-                self.status_label.config(text="Cannot drop Pawn on the last rank.")
-                return False
-        
-        # Similar restrictions for Lancer and Knight
-        if piece.name == "Lancer":
-            if (piece.is_player and y == 0) or (not piece.is_player and y == 8):
-                self.status_label.config(text="Cannot drop Lancer on the last rank.")
-                return False
-        
-        if piece.name == "Knight":
-            if (piece.is_player and y <= 1) or (not piece.is_player and y >= 7):
-                self.status_label.config(text="Cannot drop Knight on the last two ranks.")
-                return False
+        # Nifu, dead squares, pawn drop mate and king safety come from the move generator
+        self.engine.set_side_to_move(PLAYER if piece.is_player else AI)
+        move = encode_drop(piece.kind, y * 9 + x)
+        if move not in self.engine.legal_move_set():
+            return False
         
+        self.engine.play(move)
         self.board[y][x] = piece
         return True
     
     def ask_promotion(self):
         result = messagebox.askyesno("Promotion", "Do you want to promote this piece?")
         if result:
-            self.piece_to_promote.promote()
+            self.promote_piece(self.piece_to_promote, *self.promote_pos)
             self.status_label.config(text=f"{self.piece_to_promote.name} promoted!")
         
         # End player's turn regardless of promotion choice
         self.end_player_turn()
 
+    def record_moves(self):
+        # Called once a move is final, i.e. after any promotion
+        history = self.engine.history
+        if self.recorder is not None:
+            for undo in history[self.recorded_plies:]:
+                self.recorder.record(undo[0], undo[1])
+        self.recorded_plies = len(history)
+    
     def end_player_turn(self):
+        self.record_moves()
+        # Checked here rather than in move_piece so promotions and drops are included
+        if self.check_game_over():
+            return
         self.player_turn = False
         self.status_label.config(text="AI's turn...")
         self.update_board_display()
         self.start_turn_timer()  # Reset the timer for AI's turn
-        self.root.after(500, self.ai_move)  # Delay AI move for better UX
+        self.ai_start_job = self.root.after(500, self.ai_move)  # Delay AI move for better UX
     
     def ai_move(self):
-        # Improved AI with some basic strategies
-        possible_moves = []
-        
-        # Check moves for pieces on the board
-        for y in range(9):
-            for x in range(9):
-                piece = self.board[y][x]
-                if piece is not None and not piece.is_player:
-                    moves = piece.get_moves(self.board, x, y)
-                    for to_x, to_y in moves:
-                        if piece.is_valid_move(self.board, x, y, to_x, to_y):
-                            # Assign a score to this move
-                            score = 0
-                            
-                            # Higher score for capturing pieces
-                            if self.board[to_y][to_x] is not None:
-                                capture_value = self.get_piece_value(self.board[to_y][to_x])
-                                score += capture_value * 10  # Heavily weight captures
-                            
-                            # Higher score for promotion
-                            if piece.can_promote(y, to_y) or piece.must_promote(to_y):
-                                score += 5
-                            
-                            # Higher score for advancing towards opponent's king
-                            if piece.name != "King":  # Skip king for this strategy
-                                # Find player's king position
-                                king_pos = None
-                                for ky in range(9):
-                                    for kx in range(9):
-                                        if (self.board[ky][kx] is not None and 
-                                            self.board[ky][kx].name == "King" and 
-                                            self.board[ky][kx].is_player):
-                                            king_pos = (kx, ky)
-                                            break
-                                    if king_pos:
-                                        break
-                                
-                                if king_pos:
-                                    # Distance from current position to king
-                                    curr_dist = abs(x - king_pos[0]) + abs(y - king_pos[1])
-                                    # Distance from new position to king
-                                    new_dist = abs(to_x - king_pos[0]) + abs(to_y - king_pos[1])
-                                    # Reward getting closer to the king
-                                    if new_dist < curr_dist:
-                                        score += 3
-                            
-                            possible_moves.append((piece, x, y, to_x, to_y, score))
-        
-        # Check drop moves for captured pieces
-        for piece in self.ai_captures[:]:  # Create a copy of the list to avoid modification issues
-            for y in range(9):
-                for x in range(9):
-                    if self.board[y][x] is None:
-                        # Check drop restrictions
-                        if piece.name == "Pion":
-                            # Check for two pawns in the same column
-                            has_pawn = False
-                            for row in range(9):
-                                if self.board[row][x] is not None and self.board[row][x].name == "Pion" and not self.board[row][x].is_player:
-                                    has_pawn = True
-                                    break
-                            
-                            # Check for dropping on the last rank
-                            if y == 8 or has_pawn:
-                                continue
-                        
-                        elif piece.name == "Lancer" and y == 8:
-                            continue
-                        
-                        elif piece.name == "Knight" and y >= 7:
-                            continue
-                        
-                        # Assign a score to this drop
-                        score = 2  # Base score for drops
-                        
-                        # Find player's king position for strategic drops
-                        king_pos = None
-                        for ky in range(9):
-                            for kx in range(9):
-                                if (self.board[ky][kx] is not None and 
-                                    self.board[ky][kx].name == "King" and 
-                                    self.board[ky][kx].is_player):
-                                    king_pos = (kx, ky)
-                                    break
-                            if king_pos:
-                                break
-                        
-                        if king_pos:
-                            # Distance from drop position to king
-                            dist = abs(x - king_pos[0]) + abs(y - king_pos[1])
-                            # Reward drops closer to the king
-                            score += max(0, (9 - dist))
-                        
-                        possible_moves.append((piece, None, None, x, y, score))
-        
-        if possible_moves:
-            # Sort moves by score (highest first)
-            possible_moves.sort(key=lambda m: m[5], reverse=True)
-            
-            # Choose one of the top 3 moves with some randomness
-            top_moves = possible_moves[:3] if len(possible_moves) >= 3 else possible_moves
-            piece, from_x, from_y, to_x, to_y, _ = random.choice(top_moves)
-            
-            self.selected_piece = piece
-            self.selected_pos = (from_x, from_y)
-            
-            # Capture any player piece
-            if self.board[to_y][to_x] is not None:
-                captured = self.board[to_y][to_x]
-                captured.is_player = not captured.is_player
-                captured.promoted = False
-                captured.captured = True
-                self.ai_captures.append(captured)
-                self.ai_score += self.get_piece_value(captured)
-                self.status_label.config(text=f"AI captured your {captured.name}!")
-            
-            # Move or drop the AI piece
-            if from_x is not None and from_y is not None:
-                self.board[to_y][to_x] = self.board[from_y][from_x]
-                self.board[from_y][from_x] = None
-                
-                # Check for promotion
-                if piece.must_promote(to_y):
-                    piece.promote()
-                    self.status_label.config(text=f"AI's {piece.name} automatically promoted!")
-                elif piece.can_promote(from_y, to_y):
-                    # AI always promotes if beneficial
-                    piece.promote()
-                    self.status_label.config(text=f"AI's {piece.name} promoted!")
-                else:
-                    self.status_label.config(text=f"AI moved {piece.name}.")
-            else:
-                # Drop piece from captures - Add error handling
-                self.board[to_y][to_x] = piece
-                try:
-                    self.ai_captures.remove(piece)
-                    self.status_label.config(text=f"AI dropped {piece.name}.")
-                except ValueError:
-                    # Log the error but continue
-                    print(f"Warning: Could not remove piece {piece.name} from AI captures, possibly already removed")
-            
-            # Reset selection
-            self.selected_piece = None
-            self.selected_pos = None
+        # Search a copy of the position in a worker thread so the Tk loop keeps running
+        self.ai_start_job = None
+        self.engine.set_side_to_move(AI)
+        # More time for positions with many moves or in check, less for forced ones
+        soft_limit, time_limit = self.engine.time_budget(self.turn_deadline - time.perf_counter(),
+                                                         self.ai_time_fraction)
+        
+        if self.ponder_key is not None:
+            ponder_key, self.ponder_key = self.ponder_key, None
+            if ponder_key == self.position.hash_key():
+                # Ponder hit: the running search becomes the real one and keeps what it found
+                self.engine.ponder_hit(time_limit, soft_limit)
+                self.status_label.config(text="AI is thinking...")
+                self.ai_poll_job = self.root.after(50, self.poll_ai_result)
+                return
+            self.ai_stop_event.set()
+        
+        # A cancelled search stops within a few milliseconds; let it finish before reusing the searcher
+        if self.ai_thread is not None:
+            self.ai_thread.join()
+        
+        self.ai_search_id += 1
+        self.ai_stop_event = threading.Event()
+        # Copied here, the worker thread never reads the game position
+        self.ai_thread = threading.Thread(target=self.run_ai_search, daemon=True,
+                                          args=(self.ai_search_id, self.position.copy(), frozenset(self.engine.keys),
+                                                time_limit, soft_limit, self.ai_stop_event))
+        self.ai_thread.start()
+        self.status_label.config(text="AI is thinking...")
+        self.ai_poll_job = self.root.after(50, self.poll_ai_result)
+    
+    def run_ai_search(self, search_id, position, game_keys, time_limit, soft_limit, stop_event):
+        # Runs in the worker thread: no Tk calls here. A result is always posted, None
+        # when the search failed, so poll_ai_result never waits forever.
+        try:
+            result = self.engine.search_position(position, game_keys, time_limit, stop_event=stop_event,
+                                                 soft_limit=soft_limit)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        self.ai_results.put((search_id, result))
+    
+    def start_ponder(self):
+        # Think on the player's time about the reply the last search expected
+        if not self.ai_ponder or len(self.ai_pv) < 2 or self.ai_pv[1] not in self.engine.legal_move_set():
+            return
+        if self.ai_thread is not None:
+            self.ai_thread.join()
+        # Copied here, the player may move while the worker thread searches
+        position = self.position.copy()
+        position.make_move(self.ai_pv[1])
+        self.ponder_key = position.hash_key()
+        
+        self.ai_search_id += 1
+        self.ai_stop_event = threading.Event()
+        self.ai_thread = threading.Thread(target=self.run_ponder_search, daemon=True,
+                                          args=(self.ai_search_id, position, frozenset(self.engine.keys),
+                                                self.ai_stop_event))
+        self.ai_thread.start()
+    
+    def run_ponder_search(self, search_id, position, game_keys, stop_event):
+        # Worker thread, like run_ai_search; the result only counts after a ponder hit
+        try:
+            result = self.engine.ponder(position, game_keys, stop_event)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        self.ai_results.put((search_id, result))
+    
+    def poll_ai_result(self):
+        self.ai_poll_job = None
+        while True:
+            try:
+                search_id, result = self.ai_results.get_nowait()
+            except queue.Empty:
+                self.ai_poll_job = self.root.after(50, self.poll_ai_result)
+                return
+            if search_id == self.ai_search_id:
+                break
+        if result is None:
+            # The search raised: hand the turn back instead of waiting for a move
+            self.ai_pv = []
+            self.finish_ai_move(None, "AI search failed, your turn.")
+            return
+        move, score, pv = result
+        self.ai_pv = pv
+        if self.ai_stats_file:
+            self.engine.stats.dump(self.ai_stats_file, ply=len(self.engine.history))
+        self.finish_ai_move(move)
+    
+    def cancel_ai_search(self):
+        if self.ai_start_job:
+            self.root.after_cancel(self.ai_start_job)
+            self.ai_start_job = None
+        if self.ai_poll_job:
+            self.root.after_cancel(self.ai_poll_job)
+            self.ai_poll_job = None
+        self.ai_search_id += 1
+        self.ai_stop_event.set()
+        self.ponder_key = None
+    
+    def finish_ai_move(self, move, message="AI has no legal moves!"):
+        if move is not None:
+            self.apply_ai_move(move)
+            self.record_moves()
             
             # Check for game over
-            self.check_game_over()
+            if self.check_game_over():
+                return
         else:
-            self.status_label.config(text="AI has no legal moves!")
+            self.status_label.config(text=message)
         
         # End AI's turn
         self.player_turn = True
+        self.engine.set_side_to_move(PLAYER)
         self.update_board_display()
         self.start_turn_timer()  # Reset the timer for player's turn
+        self.start_ponder()
     
-    def check_game_over(self):
-        # Check if either king is captured or checkmated
-        player_king_exists = False
-        ai_king_exists = False
-        
-        for y in range(9):
-            for x in range(9):
-                if self.board[y][x] is not None:
-                    if self.board[y][x].name == "King":
-                        if self.board[y][x].is_player:
-                            player_king_exists = True
-                        else:
-                            ai_king_exists = True
+    def apply_ai_move(self, move):
+        from_sq = move & 127
+        to_sq = move >> 7 & 127
+        to_x, to_y = to_sq % 9, to_sq // 9
+        if from_sq >= DROP_BASE:
+            from_x = from_y = None
+            piece = next(p for p in self.ai_captures if p.kind == from_sq - DROP_BASE)
+        else:
+            from_x, from_y = from_sq % 9, from_sq // 9
+            piece = self.board[from_y][from_x]
         
-        if not player_king_exists:
-            messagebox.showinfo("Game Over", "AI wins! Player's king is captured.")
-            self.reset_game()
-            return True
+        # Play the move in the engine
+        self.engine.set_side_to_move(AI)
+        self.engine.play(move)
         
-        if not ai_king_exists:
-            messagebox.showinfo("Game Over", "Player wins! AI's king is captured.")
-            self.reset_game()
-            return True
+        # Capture any player piece
+        if self.board[to_y][to_x] is not None:
+            captured = self.board[to_y][to_x]
+            captured.is_player = not captured.is_player
+            captured.promoted = False
+            captured.captured = True
+            self.ai_captures.append(captured)
+            self.ai_score += self.get_piece_value(captured)
+            self.status_label.config(text=f"AI captured your {captured.name}!")
         
-        # TODO: Add checkmate detection
+        # Move or drop the AI piece
+        if from_x is not None and from_y is not None:
+            self.board[to_y][to_x] = self.board[from_y][from_x]
+            self.board[from_y][from_x] = None
+            
+            # Check for promotion
+            if move & PROMOTE_FLAG:
+                piece.promote()
+                if piece.must_promote(to_y):
+                    self.status_label.config(text=f"AI's {piece.name} automatically promoted!")
+                else:
+                    self.status_label.config(text=f"AI's {piece.name} promoted!")
+            else:
+                self.status_label.config(text=f"AI moved {piece.name}.")
+        else:
+            # Drop piece from captures
+            self.board[to_y][to_x] = piece
+            self.ai_captures.remove(piece)
+            self.status_label.config(text=f"AI dropped {piece.name}.")
+    
+    def check_game_over(self):
+        # King capture, checkmate, no legal moves and repetition, all from the engine
+        result, reason = self.engine.status()
+        if result is None:
+            return False
         
-        return False
+        if result == DRAW:
+            message = "Draw by repetition (sennichite)."
+        else:
+            winner, loser = ("Player", "AI") if result == PLAYER else ("AI", "Player")
+            if reason == KING_CAPTURED:
+                message = f"{winner} wins! {loser}'s king is captured."
+            elif reason == CHECKMATE:
+                message = f"{winner} wins! {loser} is checkmated."
+            elif reason == PERPETUAL_CHECK:
+                message = f"{winner} wins! {loser} repeated the position by perpetual check."
+            else:
+                message = f"{winner} wins! {loser} has no legal moves."
+        if self.recorder is not None:
+            self.recorder.finish(result, reason)
+        messagebox.showinfo("Game Over", message)
+        self.reset_game()
+        return True
     
     def reset_game(self):
         if self.move_timer:
             self.root.after_cancel(self.move_timer)
+        self.cancel_ai_search()
+        # A cancelled search stops within a few milliseconds; the engine is reset below
+        if self.ai_thread is not None:
+            self.ai_thread.join()
+        if self.recorder is not None:
+            self.recorder.finish()  # Only writes when a game was stopped halfway
+        self.recorded_plies = 0
             
         self.board = self.initialize_board()
+        self.engine.reset(Position.from_board(self.board))
         self.player_captures = []
         self.ai_captures = []
         self.selected_piece = None
@@ -1028,8 +3136,97 @@ class ShogiGame:
         self.start_turn_timer()
 
 def main():
+    parser = argparse.ArgumentParser(description="Shogi game. Without a command the Tk game window opens.")
+    parser.add_argument("--record", action="store_true",
+                        help="append the games played in the window to shogi_games.csa and shogi_games.sgr")
+    parser.add_argument("--ai-workers", type=int, default=1,
+                        help="processes for the AI search in the window, more than one splits the root moves")
+    commands = parser.add_subparsers(dest="command")
+    selfplay = commands.add_parser("selfplay", help="play AI-vs-AI games without a display")
+    selfplay.add_argument("--games", type=int, default=100)
+    selfplay.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    selfplay.add_argument("--time", type=float, default=0.1, help="seconds per move")
+    selfplay.add_argument("--depth", type=int, default=None, help="maximum search depth per move")
+    selfplay.add_argument("--max-plies", type=int, default=300, help="a game this long is a draw")
+    selfplay.add_argument("--random-plies", type=int, default=4, help="random opening moves per game")
+    selfplay.add_argument("--seed", type=int, default=0)
+    selfplay.add_argument("--stats", default=None, help="append the search stats of every move to this JSON lines file")
+    search_parser = commands.add_parser("search", help="search one position and print the move and search stats")
+    search_parser.add_argument("--sfen", default=START_SFEN)
+    search_parser.add_argument("--time", type=float, default=1.0, help="seconds to search")
+    search_parser.add_argument("--depth", type=int, default=None, help="maximum search depth")
+    search_parser.add_argument("--trace-allocations", action="store_true", help="also measure peak allocations (slow)")
+    search_parser.add_argument("--workers", type=int, default=1, help="processes splitting the root moves")
+    book_parser = commands.add_parser("book", help="build the opening book from game records and/or self-play")
+    book_parser.add_argument("--out", default=BOOK_FILE)
+    book_parser.add_argument("--records", nargs="*", default=[], help="files with one game of USI moves per line")
+    book_parser.add_argument("--games", type=int, default=0, help="self-play games to add")
+    book_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    book_parser.add_argument("--time", type=float, default=0.1, help="seconds per self-play move")
+    book_parser.add_argument("--depth", type=int, default=None, help="maximum search depth per self-play move")
+    book_parser.add_argument("--max-plies", type=int, default=300, help="a self-play game this long is a draw")
+    book_parser.add_argument("--random-plies", type=int, default=2, help="random opening moves per self-play game")
+    book_parser.add_argument("--plies", type=int, default=16, help="book moves kept from the start of each game")
+    book_parser.add_argument("--min-weight", type=int, default=1, help="drop book moves with a lower weight")
+    book_parser.add_argument("--seed", type=int, default=0)
+    analyze = commands.add_parser("analyze", help="search every position of recorded games (.csa text or binary)")
+    analyze.add_argument("files", nargs="+")
+    analyze.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    analyze.add_argument("--time", type=float, default=0.1, help="seconds per position")
+    analyze.add_argument("--depth", type=int, default=None, help="maximum search depth per position")
+    analyze.add_argument("--blunder", type=int, default=300, help="score loss that counts as a blunder")
+    tsume = commands.add_parser("tsume", help="solve mate problems, one SFEN per line with the attacker to move")
+    tsume.add_argument("files", nargs="+")
+    tsume.add_argument("--nodes", type=int, default=1000000, help="node budget per problem")
+    tsume.add_argument("--time", type=float, default=None, help="seconds per problem")
+    tsume.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    perft_parser = commands.add_parser("perft", help="count move sequences to check and time move generation")
+    perft_parser.add_argument("--depth", type=int, default=3)
+    perft_parser.add_argument("--sfen", default=START_SFEN, help="position to count from, default is the start position")
+    perft_parser.add_argument("--expect", type=int, nargs="*", default=None, help="reference counts from depth 1 up")
+    perft_parser.add_argument("--divide", action="store_true", help="also print the count below every root move")
+    args = parser.parse_args()
+    
+    if args.command == "selfplay":
+        run_selfplay(args.games, args.workers, args.time, args.depth, args.max_plies, args.random_plies, args.seed,
+                     args.stats)
+        return
+    if args.command == "search":
+        searcher = ParallelSearcher(args.workers) if args.workers > 1 else None
+        engine = ShogiEngine(Position.from_sfen(args.sfen), searcher)
+        engine.trace_allocations = args.trace_allocations
+        try:
+            move, score, pv = engine.search(args.time, args.depth)
+        finally:
+            if searcher is not None:
+                searcher.close()
+        print(f"Best move: {move_to_usi(move) if move is not None else 'none'} score {score}")
+        print("PV: " + " ".join(move_to_usi(pv_move) for pv_move in pv))
+        print(json.dumps(engine.stats.to_dict(), indent=2))
+        return
+    if args.command == "book":
+        if not args.records and not args.games:
+            parser.error("book needs --records and/or --games")
+        build_book(args.out, args.records, args.games, args.workers, args.time, args.depth,
+                   args.max_plies, args.plies, args.random_plies, args.seed, args.min_weight)
+        return
+    if args.command == "analyze":
+        run_analysis(args.files, args.workers, args.time, args.depth, args.blunder)
+        return
+    if args.command == "tsume":
+        run_tsume(args.files, args.nodes, args.time, args.workers)
+        return
+    if args.command == "perft":
+        position = Position.from_sfen(args.sfen)
+        reference = args.expect or PERFT_REFERENCE.get(args.sfen)
+        if not run_perft(position, args.depth, reference, args.divide):
+            sys.exit(1)
+        return
+    
+    if tk is None:
+        sys.exit("Tkinter is not available, only the command line tools can run here.")
     root = tk.Tk()
-    app = ShogiGame(root)
+    app = ShogiGame(root, args.record, args.ai_workers)
     root.mainloop()
 
 if __name__ == "__main__":